@@ -0,0 +1,114 @@
+-- Decoration provider drawing the node highlights of the lines Neovim is
+-- about to draw.
+--
+-- The highlights are kept per buffer row as a flat list of (column, end
+-- column, highlight group) triples. Rows which become visible and aren't
+-- known yet are requested from the host via a "denshi_lines" notification,
+-- the host answers with set_lines(). Only a bounded number of rows is kept,
+-- so memory use doesn't grow with the size of the buffer.
+local M = {}
+
+-- Maximum number of rows kept per buffer. When exceeded, the rows which
+-- aren't part of the update are dropped (and requested again once visible).
+M.max_rows = 2000
+
+local ns = nil
+local channel = nil
+-- Mapping (buffer -> state) of attached buffers. The state holds the
+-- mapping (row -> highlights) `rows`, their number `count` and the rows
+-- which have been requested from the host `requested`.
+local buffers = {}
+
+local function redraw(buf, first, last)
+  if vim.api.nvim__redraw ~= nil then
+    vim.api.nvim__redraw({buf = buf, range = {first, last}})
+  else
+    vim.api.nvim__buf_redraw_range(buf, first, last)
+  end
+end
+
+local function reset(state)
+  state.rows = {}
+  state.count = 0
+  state.requested = {}
+end
+
+function M.setup(namespace, chan)
+  ns = namespace
+  channel = chan
+  vim.api.nvim_set_decoration_provider(ns, {
+    on_win = M.on_win,
+    on_line = M.on_line,
+  })
+end
+
+function M.attach(buf)
+  local state = {}
+  reset(state)
+  buffers[buf] = state
+end
+
+function M.detach(buf)
+  buffers[buf] = nil
+  redraw(buf, 0, -1)
+end
+
+-- Store highlights `data` (one list per row) of the rows `first` to `last`
+-- (0-based, exclusive). With `replace`, all other rows are dropped.
+function M.set_lines(buf, first, last, data, replace)
+  local state = buffers[buf]
+  if state == nil then
+    return
+  end
+  if replace or state.count + last - first > M.max_rows then
+    reset(state)
+  end
+  local rows = state.rows
+  local requested = state.requested
+  for i = 1, last - first do
+    local row = first + i - 1
+    if rows[row] == nil then
+      state.count = state.count + 1
+    end
+    rows[row] = data[i]
+    requested[row] = nil
+  end
+  redraw(buf, first, last)
+end
+
+function M.on_win(_, _, buf, toprow, botrow)
+  local state = buffers[buf]
+  if state == nil then
+    return false
+  end
+  local rows = state.rows
+  local requested = state.requested
+  local first, last
+  for row = toprow, botrow do
+    if rows[row] == nil and not requested[row] then
+      requested[row] = true
+      first = first or row
+      last = row
+    end
+  end
+  if first ~= nil then
+    vim.rpcnotify(channel, 'denshi_lines', buf, first, last + 1)
+  end
+end
+
+function M.on_line(_, _, buf, row)
+  local data = buffers[buf].rows[row]
+  if data == nil then
+    return
+  end
+  for i = 1, #data, 3 do
+    vim.api.nvim_buf_set_extmark(buf, ns, row, data[i], {
+      end_col = data[i + 1],
+      hl_group = data[i + 2],
+      ephemeral = true,
+      strict = false,
+    })
+  end
+end
+
+return M
@@ -69,7 +69,7 @@ function! denshi#buffer_attach()
     let b:denshi_attached = v:true
     augroup DenshiEvents
         autocmd! * <buffer>
-        autocmd BufEnter <buffer> call DenshiBufEnter(+expand('<abuf>'), line('w0'), line('w$'))
+        autocmd BufEnter <buffer> call DenshiBufEnter(+expand('<abuf>'), line('w0'), line('w$'), tabpagebuflist())
         autocmd BufLeave <buffer> call DenshiBufLeave()
         autocmd VimResized <buffer> call DenshiVimResized(line('w0'), line('w$'))
         autocmd TextChanged <buffer> call DenshiTextChanged()
@@ -77,7 +77,7 @@ function! denshi#buffer_attach()
         autocmd CursorMoved <buffer> call DenshiCursorMoved(line('w0'), line('w$'))
         autocmd CursorMovedI <buffer> call DenshiCursorMoved(line('w0'), line('w$'))
     augroup END
-    call DenshiBufEnter(bufnr('%'), line('w0'), line('w$'))
+    call DenshiBufEnter(bufnr('%'), line('w0'), line('w$'), tabpagebuflist())
 endfunction
 
 function! denshi#buffer_detach()
@@ -87,6 +87,13 @@ function! denshi#buffer_detach()
     augroup END
 endfunction
 
+" Return the buffers of the windows in the current tab page, except the
+" window `winid` (which is being closed)
+function! s:visible_buffers(winid)
+    let windows = filter(gettabinfo(tabpagenr())[0].windows, 'v:val != a:winid')
+    return map(windows, 'winbufnr(v:val)')
+endfunction
+
 function! denshi#init()
     if g:denshi#no_default_builtin_highlight
         call s:disable_builtin_highlights()
@@ -97,6 +104,8 @@ function! denshi#init()
 
     autocmd FileType * call s:filetype_changed()
     autocmd BufWipeout * call DenshiBufWipeout(+expand('<abuf>'))
+    autocmd WinEnter,TabEnter * call DenshiRank(bufnr('%'), tabpagebuflist())
+    autocmd WinClosed * call DenshiRank(bufnr('%'), s:visible_buffers(+expand('<amatch>')))
 endfunction
 
 call denshi#init()
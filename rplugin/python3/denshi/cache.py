@@ -0,0 +1,330 @@
+"""Caches for parser results.
+
+Results are keyed by a hash of the code together with the identity of the
+parser binary and its config, so a changed binary or config never serves
+stale nodes.
+"""
+from array import array
+from collections import OrderedDict
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+from threading import Lock, Thread
+import zlib
+
+from .table import NodeTable
+from .util import logger
+
+
+# Content hashes of config files, keyed by their (path, mtime, size)
+_config_hashes = {}
+
+
+def parser_identity(binary_location, config_location):
+    """Return a hashable identity of the parser binary and config.
+
+    The binary is identified by its path, mtime and size, the config by a
+    hash of its contents. The identity changes whenever one of them is
+    modified.
+    """
+    try:
+        stat = os.stat(binary_location)
+    except OSError:
+        binary = (binary_location, None, None)
+    else:
+        binary = (binary_location, stat.st_mtime_ns, stat.st_size)
+    return (binary, _config_hash(config_location))
+
+
+def _config_hash(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    stamp = (path, stat.st_mtime_ns, stat.st_size)
+    try:
+        return _config_hashes[stamp]
+    except KeyError:
+        pass
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except OSError:
+        return None
+    _config_hashes[stamp] = digest
+    return digest
+
+
+def cache_key(code, identity):
+    """Return the cache key for `code` parsed by the parser `identity`."""
+    digest = hashlib.blake2b(repr(identity).encode('utf-8'), digest_size=16)
+    digest.update(code.encode('utf-8'))
+    return digest.digest()
+
+
+class ParseCache:
+    """In-memory LRU cache mapping cache keys to node tables.
+
+    The cache holds at most `max_size` bytes (as estimated by the tables).
+    Least recently used entries are evicted first. If a DiskCache `disk` is
+    given, it is consulted on misses and receives the entries which are
+    persisted. Tables are shared with the callers, so they must not be
+    modified.
+    """
+    def __init__(self, max_size, disk=None):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._disk = disk
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __repr__(self):
+        return '<ParseCache %d entries, %d/%d bytes, %d hits, %d misses%s>' % (
+            len(self._entries), self.size, self.max_size, self.hits,
+            self.misses, '' if self._disk is None else ', %r' % self._disk)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return NodeTable stored for `key`, or None."""
+        with self._lock:
+            try:
+                table, _ = self._entries[key]
+            except KeyError:
+                pass
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return table
+        if self._disk is not None:
+            table = self._disk.get(key)
+            if table is not None:
+                self._put_memory(key, table)
+                return table
+        self.misses += 1
+        return None
+
+    def put(self, key, table, persist=False):
+        """Store NodeTable `table` for `key`. If `persist`, it's also
+        written to the disk cache (in the background)."""
+        self._put_memory(key, table)
+        if persist and self._disk is not None:
+            self._disk.put_later(key, table)
+
+    def persist(self, key):
+        """Write the entry of `key` (if it's still cached) to the disk cache
+        in the background."""
+        if self._disk is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            self._disk.put_later(key, entry[0])
+
+    def flush(self, timeout=None):
+        """Wait until pending disk cache writes are done."""
+        if self._disk is not None:
+            self._disk.flush(timeout)
+
+    def _put_memory(self, key, table):
+        size = table.nbytes
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (table, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+class DiskCache:
+    """Persistent cache of node tables in the directory `directory`, shared
+    between Neovim sessions.
+
+    Every entry is a file named after its key. A table is stored as its
+    zlib-compressed list of unique strings followed by its columns (arrays
+    of unsigned ints). When the total size exceeds `max_size` bytes, the
+    least recently used files are deleted. Writes queued with `put_later()`
+    are done by a background thread.
+    """
+    MAGIC = b'DNS2'
+    _header = struct.Struct('<4sIII')
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Total size of the cache directory (computed on first write)
+        self._size = None
+        self._lock = Lock()
+        # Mapping (key -> table) of entries waiting to be written, and the
+        # thread writing them
+        self._pending = {}
+        self._writer = None
+
+    def __repr__(self):
+        return '<DiskCache %s, %d hits, %d misses, %d pending>' % (
+            self.directory, self.hits, self.misses, len(self._pending))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.hex())
+
+    def get(self, key):
+        """Return NodeTable stored for `key`, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            table = self.decode(data)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, zlib.error, struct.error) as e:
+            logger.debug('discarding cache entry %s: %s', path, e)
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            # Mark entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return table
+
+    def put(self, key, table):
+        """Store NodeTable `table` for `key`."""
+        data = self.encode(table)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file first, so other sessions never read a
+            # partially written entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.error('Failed to write parse cache entry: %s', e)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._total_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._prune()
+
+    def put_later(self, key, table):
+        """Store NodeTable `table` for `key` in the background."""
+        with self._lock:
+            self._pending[key] = table
+            if self._writer is None:
+                self._writer = Thread(target=self._write_pending,
+                                      name='denshi-disk-cache', daemon=True)
+                self._writer.start()
+
+    def flush(self, timeout=None):
+        """Wait until the pending writes are done."""
+        writer = self._writer
+        if writer is not None:
+            writer.join(timeout)
+
+    def _write_pending(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._writer = None
+                    return
+                key, table = self._pending.popitem()
+            self.put(key, table)
+
+    def _entries(self):
+        """Return list of (`mtime`, `size`, `path`) of all entries."""
+        entries = []
+        try:
+            dir_entries = list(os.scandir(self.directory))
+        except OSError:
+            return entries
+        for entry in dir_entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _total_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _prune(self):
+        """Delete least recently used entries until the cache has shrunk to
+        three quarters of its maximum size."""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_size * 3 // 4
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            self._remove(path)
+            size -= entry_size
+        self._size = size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @classmethod
+    def encode(cls, table):
+        """Return NodeTable `table` in the binary entry format."""
+        strings = '\0'.join(table.strings).encode('utf-8')
+        columns = [getattr(table, c) for c in NodeTable.COLUMNS]
+        if sys.byteorder != 'little':
+            columns = [array('I', c) for c in columns]
+            for column in columns:
+                column.byteswap()
+        header = cls._header.pack(cls.MAGIC, len(table), len(table.strings),
+                                  len(strings))
+        return zlib.compress(
+            b''.join([header, strings, *(c.tobytes() for c in columns)]), 1)
+
+    @classmethod
+    def decode(cls, data):
+        """Return NodeTable stored in the binary entry format `data`."""
+        data = zlib.decompress(data)
+        header = cls._header
+        magic, num_rows, num_strings, strings_size = header.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError('bad magic %r' % magic)
+        start = header.size
+        strings = data[start:start + strings_size].decode('utf-8').split('\0')
+        if len(strings) != num_strings and num_strings:
+            raise ValueError('bad string table')
+        start += strings_size
+        column_size = 4 * num_rows
+        if len(data) - start != len(NodeTable.COLUMNS) * column_size:
+            raise ValueError('bad columns')
+        columns = []
+        for _ in NodeTable.COLUMNS:
+            column = array('I')
+            column.frombytes(data[start:start + column_size])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            start += column_size
+        return NodeTable(strings if num_strings else [], *columns)
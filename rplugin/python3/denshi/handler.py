@@ -1,19 +1,38 @@
+import asyncio
 from collections import defaultdict
+from functools import partial
 import threading
-import time
+
+import msgpack
 
 try:
     import pynvim as neovim
 except ImportError:
     import neovim
 
-from .parser import Parser, UnparsableError
+from .parser import Parser, ParseCancelled, UnparsableError
+from .shadow import ShadowBuffer
 from .util import logger, debug_time, lines_to_code
-from .node import Node, SELECTED
+from .node import SELECTED
+from .worker import (PRIORITY_ERROR_SIGN, PRIORITY_UPDATE, PRIORITY_VIEWPORT,
+                     RANK_CURRENT, RANK_HIDDEN)
 
 
 ERROR_SIGN_ID = 314000
-ERROR_HL_ID = 313000
+# Maximum msgpack size of a call_atomic() request in bytes. Larger requests
+# are split to avoid https://github.com/neovim/python-client/issues/310
+MAX_BATCH_SIZE = 512 * 1024
+# Upper bound of the msgpack size of a buffer handle
+BUFFER_PACKED_SIZE = 6
+# Upper bound of the msgpack size of a call_atomic() request without its
+# calls
+REQUEST_PACKED_SIZE = 64
+# Integer packed in place of those of a sample call, as an upper bound of
+# their size (line numbers and IDs fit into 32 bits)
+SAMPLE_INT = 2 ** 32 - 1
+# Extmark priority of the marks of selected nodes, so they are drawn over the
+# node highlights (which have the default priority)
+SELECTED_PRIORITY = 4097
 
 
 class BufferHandler:
@@ -21,67 +40,278 @@ class BufferHandler:
 
     The handler runs the parser, adds and removes highlights, keeps tracks of
     which highlights are visible and which ones need to be added or removed.
+    Updates run on the UpdateWorker `worker` shared between handlers, or as
+    tasks on the event loop if there is a denshi.pipeline.AsyncPipeline
+    `pipeline`.
     """
-    def __init__(self, buf, vim, options):
+    def __init__(self, buf, vim, options, worker, session=None, cache=None,
+                 hl_ids=None, pipeline=None):
         self._buf = buf
         self._vim = vim
         self._options = options
+        self._worker = worker
+        self._pipeline = pipeline
+        # State of the asyncio pipeline: the running update task, whether it
+        # needs to run again, the task of its parse and the error sign timer
+        self._update_task = None
+        self._update_again = False
+        self._parse_task = None
+        self._error_timer = None
+        self._closed = False
         self._buf_num = buf.number
+        # Optional HighlightIds shared between handlers, to refer to
+        # highlight groups by ID
+        self._hl_ids = hl_ids
+        # Extmark namespaces of the node highlights of this buffer, of the
+        # marks of selected nodes and of the syntax error indicator
+        self._ns = vim.api.create_namespace('denshi-%d' % self._buf_num)
+        # Namespace which is filled on full refreshes while the highlights
+        # in `_ns` stay visible, and then swapped with it
+        self._back_ns = vim.api.create_namespace(
+            'denshi-%d-back' % self._buf_num)
+        self._mark_ns = vim.api.create_namespace('denshi-selected')
+        self._error_ns = vim.api.create_namespace('denshi-error')
         self._parser = Parser(self._options.config_location,
                               self._options.binary_location,
                               options.excluded_hl_groups,
-                              options.tolerate_syntax_errors)
-        self._scheduled = False
-        self._viewport_changed = False
+                              options.tolerate_syntax_errors,
+                              session=session,
+                              transport=options.parser_transport,
+                              cache=cache,
+                              diff_window=options.diff_window)
         self._view = (0, 0)
-        self._update_thread = None
-        self._error_timer = None
+        # Visibility rank of the buffer (see set_rank())
+        self._rank = RANK_CURRENT
         self._indicated_syntax_error = None
-        # Nodes which are active but pending to be displayed because they are
-        # in a currently invisible area.
-        self._pending_nodes = []
+        # Number of call_atomic requests sent since the current update
+        # started, for the debug log. It's approximate, as requests sent by
+        # other jobs meanwhile (like adding highlights which have become
+        # visible) are counted as well.
+        self._update_rpcs = 0
+        # IDs of nodes which are active but pending to be displayed because
+        # they are in a currently invisible area. The parser's node store
+        # buckets the nodes by line (and moves them along when lines are
+        # inserted or deleted), so we only need to remember which are pending.
+        self._pending_ids = set()
         # Nodes which are currently marked as a selected. We keep track of them
         # to check if they haven't changed between updates.
         self._selected_nodes = []
+        # If set, highlights are drawn by the decoration provider (see
+        # lua/denshi/provider.lua), which requests them for the lines it
+        # draws, so there's no need to track visible and pending nodes.
+        self._provider = options.decoration_provider
+        if self._provider:
+            vim.exec_lua('require("denshi.provider").attach(...)',
+                         self._buf_num)
+        # Copy of the buffer lines, synced via nvim_buf_attach() line events
+        self._shadow = None
+        # Serializes taking a snapshot of the shadow and parsing it, so the
+        # parser receives the snapshots' hunks in order
+        self._shadow_lock = threading.Lock()
+        if options.incremental_sync:
+            self._shadow = ShadowBuffer()
+            self._attach()
 
     def __repr__(self):
         return '<BufferHandler(%d)>' % self._buf_num
 
+    @property
+    def superseded_parses(self):
+        """Number of parses cancelled because the buffer changed meanwhile."""
+        return self._parser.superseded
+
     def viewport(self, start, stop):
         """Set viewport to line range from `start` to `stop` and add highlights
         that have become visible."""
         range = stop - start
         self._view = (start - range, stop + range)
-        # If the update thread is running, we defer addding visible highlights
-        # for the new viewport to after the update loop is done.
-        if self._update_thread is not None and self._update_thread.is_alive():
-            self._viewport_changed = True
+        if self._provider:
+            # The decoration provider requests new lines itself
+            return
+        if self._pipeline is not None:
+            # Updates only change pending nodes between awaits, so there is
+            # no need to wait for them
+            self._add_visible_hls()
             return
-        self._add_visible_hls()
+        # Runs on the worker, so it doesn't interleave with an update
+        self._submit('viewport', self._add_visible_hls, PRIORITY_VIEWPORT)
 
-    def update(self, force=False, sync=False):
+    def update(self, force=False, sync=False, changed=False):
         """Update.
 
-        If `sync`, trigger update immediately, otherwise start thread to update
-        code if thread isn't running already.
+        If `sync`, run the update ahead of all waiting jobs and wait for
+        it, otherwise queue an update on the worker (unless one is waiting
+        already). If `changed`, the buffer
+        content has changed, so a parse which is currently running is out of
+        date and gets cancelled.
         """
+        if self._shadow is not None and self._shadow.lines is None:
+            # Detached (e.g. because the buffer was reloaded), so attach again
+            self._attach()
         if sync:
-            self._update_step(force=force, sync=True)
+            self._run_sync(partial(self._update_step, force=force))
+            return
+        if self._pipeline is not None:
+            self._update_soon(changed)
             return
-        thread = self._update_thread
-        # If there is an active update thread...
-        if thread is not None and thread.is_alive():
-            # ...just make sure sure it runs another time.
-            self._scheduled = True
+        if changed:
+            self._parser.cancel()
+        hidden = self._rank == RANK_HIDDEN
+        self._submit('update', self._update_job, PRIORITY_UPDATE,
+                     delay=self._update_delay(hidden), idle=hidden)
+
+    def _update_delay(self, hidden):
+        """Return the seconds to wait before an update, which grow with
+        the buffer size (see `g:denshi#update_delay_factor`), and are at
+        least `g:denshi#hidden_update_delay` if the buffer is `hidden`."""
+        delay = self._options.update_delay_factor * len(self._parser.lines)
+        if hidden:
+            delay = max(delay, self._options.hidden_update_delay)
+        return delay
+
+    def set_rank(self, rank):
+        """Set the visibility rank of the buffer, which orders its jobs
+        relative to those of other buffers.
+
+        Updates of hidden buffers are deferred until no other job is running
+        and the buffer hasn't changed for a while. The other waiting jobs
+        keep their delays.
+        """
+        if rank == self._rank:
+            return
+        self._rank = rank
+        hidden = rank == RANK_HIDDEN
+        self._worker.reschedule(('update', self._buf_num), rank,
+                                delay=self._update_delay(hidden), idle=hidden)
+        for kind in ('viewport', 'error'):
+            self._worker.reschedule((kind, self._buf_num), rank)
+
+    def _update_soon(self, changed):
+        """Start the update task on the event loop, or make the running one
+        update again. If `changed`, its parse is cancelled."""
+        task = self._update_task
+        if task is not None and not task.done():
+            self._update_again = True
+            if changed and self._parse_task is not None:
+                self._parse_task.cancel()
             return
-        # Otherwise, start a new update thread.
-        thread = threading.Thread(target=self._update_loop)
-        self._update_thread = thread
-        thread.start()
+        self._update_task = self._pipeline.loop.create_task(
+            self._update_loop_async())
+
+    async def _update_loop_async(self):
+        pipeline = self._pipeline
+        try:
+            while True:
+                hidden = self._rank == RANK_HIDDEN
+                delay = self._update_delay(hidden)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                async with pipeline.slots.slot(self._rank, idle=hidden):
+                    # Changes until here are in the snapshot of this update
+                    self._update_again = False
+                    await self._update_step_async(
+                        self._options.always_update_all_highlights)
+                if not self._update_again:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            import traceback # pylint: disable=import-outside-toplevel
+            logger.error('Exception: %s', traceback.format_exc())
+
+    async def _update_step_async(self, force=False):
+        """Like `_update_step()`, but awaits the buffer content, the parser
+        and the cursor position on the event loop."""
+        pipeline = self._pipeline
+        self._update_rpcs = 0
+        code, hunk, tick = await self._buffer_code_async()
+        parse = pipeline.loop.create_task(self._parser.parse_async(
+            code, force, hunk, session=pipeline.session))
+        self._parse_task = parse
+        try:
+            add, rem = await parse
+        except asyncio.CancelledError:
+            if self._closed:
+                raise
+            # The buffer changed, the update loop runs again
+            return
+        except UnparsableError:
+            pass
+        else:
+            stale = not force and await self._changed_since_async(tick)
+            self._show_changes(add, rem, force, stale)
+            self.mark_selected(
+                await pipeline.nvim.request('nvim_win_get_cursor', 0))
+        finally:
+            self._parse_task = None
+        if self._options.error_sign:
+            self._schedule_update_error_sign()
+
+    async def _buffer_code_async(self):
+        """Return tuple (`code`, `hunk`, `tick`) of the buffer content, the
+        hunk of changes since the last call (or None if unknown) and the
+        changedtick of the content."""
+        if self._shadow is not None:
+            with self._shadow_lock:
+                snapshot = self._shadow.snapshot()
+                tick = self._shadow.snapshot_tick
+            if snapshot is not None:
+                return (*snapshot, tick)
+        (lines, tick), error = await self._pipeline.nvim.request(
+            'nvim_call_atomic', self._buffer_code_calls())
+        if error is not None:
+            raise neovim.api.NvimError(error[2])
+        return lines_to_code(lines), None, tick
+
+    async def _changed_since_async(self, tick):
+        """Like `_changed_since()`, but awaits the changedtick on the event
+        loop."""
+        if tick is None:
+            return True
+        if self._shadow is not None and self._shadow.lines is not None:
+            return self._shadow.changedtick != tick
+        return await self._pipeline.nvim.request(
+            'nvim_buf_get_changedtick', self._buf_num) != tick
+
+    def _run_sync(self, func):
+        """Run `func(sync=...)` and wait for it.
+
+        It runs on the worker ahead of all other jobs, as job 'update' of
+        this buffer, so it never interleaves with other jobs changing the
+        highlights of the buffer. With the asyncio pipeline, it runs right
+        away on the loop.
+        """
+        if self._pipeline is not None:
+            func(sync=True)
+            return
+        self._worker.run(('update', self._buf_num), partial(func, sync=False),
+                         group=self._buf_num)
+
+    def _submit(self, kind, func, priority, delay=0, idle=False):
+        """Queue `func` as the job `kind` of this buffer on the worker."""
+        self._worker.submit((kind, self._buf_num), func, priority,
+                            delay=delay, rank=self._rank, group=self._buf_num,
+                            idle=idle)
+
+    def _attach(self):
+        """Subscribe to line events of the buffer to keep the shadow copy
+        up to date. The initial event contains all lines."""
+        try:
+            self._buf.api.attach(True, {})
+        except neovim.api.NvimError as e:
+            logger.error('Failed to attach to buffer: %s', e)
+
+    def on_lines(self, changedtick, first, last, linedata):
+        """Handle an nvim_buf_lines_event for the buffer."""
+        self._shadow.on_lines(changedtick, first, last, linedata)
+
+    def on_detach(self):
+        """Handle an nvim_buf_detach_event for the buffer."""
+        self._shadow.reset()
 
     def clear_highlights(self):
         """Clear all highlights."""
-        self._update_step(force=True, sync=True, code='')
+        self._run_sync(partial(self._update_step, force=True, code=''))
 
     @debug_time
     def mark_selected(self, cursor):
@@ -94,14 +324,15 @@ class BufferHandler:
             return
         mark_original = bool(self._options.mark_selected_nodes - 1)
         nodes = self._parser.same_nodes(cursor, mark_original,
-                                        self._options.self_to_attribute)
-        start, stop = self._view
-        nodes = [n for n in nodes if start <= n.lineno <= stop]
+                                        self._options.self_to_attribute,
+                                        view=self._view)
         if nodes == self._selected_nodes:
             return
         self._selected_nodes = nodes
-        self._clear_hls(nodes_to_hl(nodes, clear=True, marked=True))
-        self._add_hls(nodes_to_hl(nodes, marked=True))
+        hls = nodes_to_hl(nodes, marked=True, hl_ids=self._hl_ids)
+        self._call_atomic_async(
+            self._clear_calls([(0, -1)], self._mark_ns) +
+            self._add_calls(hls, self._mark_ns))
 
     def _wait_for(self, func, sync=False):
         """Return `func()`. If not `sync`, run `func` in async context and
@@ -111,15 +342,7 @@ class BufferHandler:
         """
         if sync:
             return func()
-        event = threading.Event()
-        res = None
-        def wrapper():
-            nonlocal res
-            res = func()
-            event.set()
-        self._vim.async_call(wrapper)
-        event.wait()
-        return res
+        return self._worker.wait_main(func)
 
     def _wrap_async(self, func):
         """
@@ -127,64 +350,164 @@ class BufferHandler:
         from the main thread. This is a requirement of neovim API when
         function call happens from other threads.
         Related issue: https://github.com/numirias/semshi/issues/25
+
+        The calls run in order with those of all other jobs on the worker
+        (see UpdateWorker.call_main()). With the asyncio pipeline, everything
+        runs on the main thread already, so `func` is returned as it is.
         """
+        if self._pipeline is not None:
+            return func
         def wrapper(*args, **kwargs):
-            return self._vim.async_call(func, *args, **kwargs)
+            return self._worker.call_main(func, *args, **kwargs)
         return wrapper
 
-    def _update_loop(self):
-        try:
-            while True:
-                delay_factor = self._options.update_delay_factor
-                if delay_factor > 0:
-                    time.sleep(delay_factor * len(self._parser.lines))
-                self._update_step(self._options.always_update_all_highlights)
-                if not self._scheduled:
-                    break
-                self._scheduled = False
-            if self._viewport_changed:
-                self._add_visible_hls()
-                self._viewport_changed = False
-        except Exception:
-            import traceback # pylint: disable=import-outside-toplevel
-            logger.error('Exception: %s', traceback.format_exc())
-            raise
+    def _update_job(self):
+        self._update_step(self._options.always_update_all_highlights)
 
-    @debug_time
+    # pylint: disable=protected-access
+    @debug_time(None, lambda s, *_, **__: '%d RPCs' % s._update_rpcs)
     def _update_step(self, force=False, sync=False, code=None):
         """Trigger parser, update highlights accordingly, and trigger update of
         error sign.
         """
-        if code is None:
-            code = self._wait_for(lambda: lines_to_code(self._buf[:]), sync)
+        self._update_rpcs = 0
         try:
-            add, rem = self._parser.parse(code, force)
+            add, rem, tick = self._parse_buffer(force, sync, code)
             logger.error('Exception: %s %s', add, rem)
+        except ParseCancelled:
+            # The update loop runs again with the newer code
+            return
         except UnparsableError:
             pass
         else:
-            # TODO If we force update, can't we just clear all pending?
-            # Remove nodes to be cleared from pending list
-            rem_remaining = debug_time('remove from pending')(
-                lambda: list(self._remove_from_pending(rem)))()
-            add_visible, add_hidden = self._visible_and_hidden(add)
-            # Add all new but hidden nodes to pending list
-            self._pending_nodes += add_hidden
-            # Update highlights by adding all new visible nodes and removing
-            # all old nodes which have been drawn earlier
-            self._update_hls(add_visible, rem_remaining)
+            stale = not force and self._changed_since(tick, sync)
+            self._show_changes(add, rem, force, stale)
             self.mark_selected(
                 self._wait_for(lambda: self._vim.current.window.cursor, sync))
         if self._options.error_sign:
             self._schedule_update_error_sign()
 
+    def _show_changes(self, add, rem, force, stale=False):
+        """Update highlights after nodes `add` have been added and nodes
+        `rem` removed (or all nodes have been replaced by `add` if
+        `force`).
+
+        If `stale`, the buffer has changed since the parse, so the extmarks
+        may have moved away from the lines of the removed nodes. Then all
+        highlights are replaced instead of clearing those lines.
+        """
+        if self._provider:
+            # Replace the highlights the provider holds by those around
+            # the viewport. It requests other lines when they're drawn.
+            start, stop = self._view
+            self.serve_lines(max(start - 1, 0), stop, replace=True)
+        elif force:
+            self._swap_hls(add)
+        elif stale:
+            self._swap_hls(self._parser.all_nodes())
+        else:
+            self._apply_changes(add, rem)
+
+    def _apply_changes(self, add, rem):
+        """Update highlights and pending nodes after nodes `add` have been
+        added and nodes `rem` removed."""
+        # Remove nodes to be cleared from pending set
+        rem_remaining = debug_time('remove from pending')(
+            lambda: list(self._remove_from_pending(rem)))()
+        add_visible, add_hidden = self._visible_and_hidden(add)
+        # Add all new but hidden nodes to pending set
+        self._pending_ids.update(n.id for n in add_hidden)
+        # Update highlights by adding all new visible nodes and removing
+        # all old nodes which have been drawn earlier
+        self._update_hls(add_visible, rem_remaining)
+
+    @debug_time(None, lambda _, nodes: '%d nodes' % len(nodes))
+    def _swap_hls(self, nodes):
+        """Replace all highlights by those of `nodes`.
+
+        The new highlights are added to the back namespace, and the front
+        namespace is cleared in the same batch as the last of them, so there
+        is never a frame drawn without highlights.
+        """
+        visible, hidden = self._visible_and_hidden(nodes)
+        self._pending_ids = {n.id for n in hidden}
+        back_ns = self._back_ns
+        hls = nodes_to_hl(visible, hl_ids=self._hl_ids)
+        self._call_atomic_async(
+            self._add_calls(hls, back_ns) + self._clear_calls([(0, -1)]))
+        self._ns, self._back_ns = back_ns, self._ns
+
+    def _parse_buffer(self, force, sync, code):
+        """Parse `code`, or the current buffer content if `code` is None, and
+        return tuple (`add`, `remove`, `tick`) of the parser result and the
+        changedtick of the parsed content (None if unknown)."""
+        if code is None and self._shadow is not None:
+            with self._shadow_lock:
+                snapshot = self._shadow.snapshot()
+                if snapshot is not None:
+                    code, hunk = snapshot
+                    tick = self._shadow.snapshot_tick
+                    return (*self._parser.parse(code, force, hunk), tick)
+        tick = None
+        if code is None:
+            code, tick = self._wait_for(self._buffer_code, sync)
+        return (*self._parser.parse(code, force), tick)
+
+    def _buffer_code(self):
+        """Return tuple (`code`, `tick`) of the buffer content and its
+        changedtick. Must be called from the main thread."""
+        (lines, tick), error = self._vim.api.call_atomic(
+            self._buffer_code_calls())
+        if error is not None:
+            raise neovim.api.NvimError(error[2])
+        return lines_to_code(lines), tick
+
+    def _buffer_code_calls(self):
+        """Return API calls getting the buffer lines and changedtick, so
+        they're read together."""
+        return [('nvim_buf_get_lines', (self._buf_num, 0, -1, False)),
+                ('nvim_buf_get_changedtick', (self._buf_num,))]
+
+    def _changed_since(self, tick, sync=False):
+        """Return whether the buffer has changed since changedtick `tick`
+        (or it's unknown).
+
+        With the shadow buffer, the changedtick of the last line event is
+        compared, which costs no request.
+        """
+        if tick is None:
+            return True
+        if self._shadow is not None and self._shadow.lines is not None:
+            return self._shadow.changedtick != tick
+        return self._wait_for(self._buf.api.get_changedtick, sync) != tick
+
+    @debug_time(None, lambda _, first, last, **__: '%d-%d' % (first, last))
+    def serve_lines(self, first, last, replace=False):
+        """Send the highlights of the lines `first` to `last` (0-based,
+        exclusive) to the decoration provider. With `replace`, it drops the
+        highlights of all other lines."""
+        last = max(first, min(last, len(self._parser.lines)))
+        group_id = hl_group_id(self._hl_ids)
+        rows = [[] for _ in range(last - first)]
+        for node in self._parser.nodes_in_lines(first + 1, last):
+            rows[node.lineno - 1 - first] += (node.col, node.end,
+                                              group_id(node.hl_group))
+        self._wrap_async(self._vim.exec_lua)(
+            'require("denshi.provider").set_lines(...)',
+            self._buf_num, first, last, rows, replace, async_=True)
+
     @debug_time
     def _add_visible_hls(self):
         """Add highlights in the current viewport which have not been applied
         yet."""
-        visible, hidden = self._visible_and_hidden(self._pending_nodes)
-        self._add_hls(nodes_to_hl(visible))
-        self._pending_nodes = hidden
+        pending = self._pending_ids
+        if not pending:
+            return
+        start, end = self._view
+        visible = [n for n in self._parser.nodes_in_lines(start, end)
+                   if n.id in pending]
+        pending.difference_update(n.id for n in visible)
+        self._add_hls(nodes_to_hl(visible, hl_ids=self._hl_ids))
 
     def _visible_and_hidden(self, nodes):
         """Bisect nodes into visible and hidden ones."""
@@ -199,30 +522,34 @@ class BufferHandler:
         return visible, hidden
 
     # pylint: disable=protected-access
-    @debug_time(None, lambda s, n: '%d / %d' % (len(n), len(s._pending_nodes)))
+    @debug_time(None, lambda s, n: '%d / %d' % (len(n), len(s._pending_ids)))
     def _remove_from_pending(self, nodes):
-        """Return nodes which couldn't be removed from the pending list (which
+        """Return nodes which couldn't be removed from the pending set (which
         means they need to be cleared from the buffer).
         """
+        pending = self._pending_ids
         for node in nodes:
             try:
-                self._pending_nodes.remove(node)
-            except ValueError:
-                # TODO Can we maintain a list of nodes that should be active
-                # instead of creating it here?
+                pending.remove(node.id)
+            except KeyError:
                 yield node
 
     def _schedule_update_error_sign(self):
+        key = ('error', self._buf_num)
         if self._error_timer is not None:
             self._error_timer.cancel()
+            self._error_timer = None
         if self._indicated_syntax_error is not None:
+            self._worker.cancel(key)
             self._update_error_indicator()
             return
         # Delay update to prevent the error sign from flashing while typing.
-        timer = threading.Timer(self._options.error_sign_delay,
-                                self._update_error_indicator)
-        self._error_timer = timer
-        timer.start()
+        if self._pipeline is not None:
+            self._error_timer = self._pipeline.loop.call_later(
+                self._options.error_sign_delay, self._update_error_indicator)
+            return
+        self._submit('error', self._update_error_indicator,
+                     PRIORITY_ERROR_SIGN, delay=self._options.error_sign_delay)
 
     def _update_error_indicator(self):
         cur_error = self._indicated_syntax_error
@@ -233,18 +560,16 @@ class BufferHandler:
            (cur_error.lineno, cur_error.offset, cur_error.msg):
             return
         self._unplace_sign(ERROR_SIGN_ID)
-        self._wrap_async(self._buf.clear_highlight)(ERROR_HL_ID)
+        self._clear_hls([(0, -1)], self._error_ns)
         if error is None:
             return
         self._place_sign(ERROR_SIGN_ID, error.lineno, 'denshiError')
         lineno, offset = self._error_pos(error)
-        self._wrap_async(self._buf.add_highlight)(
-            'denshiErrorChar',
-            lineno - 1,
-            offset,
-            offset + 1,
-            ERROR_HL_ID,
-        )
+        self._add_hls([(lineno - 1, offset, {
+            'end_col': offset + 1,
+            'hl_group': 'denshiErrorChar',
+            'strict': False,
+        })], self._error_ns)
 
     def _place_sign(self, id, line, name):
         self._wrap_async(self._vim.command)(
@@ -260,42 +585,65 @@ class BufferHandler:
 
     @debug_time(None, lambda _, a, c: '+%d, -%d' % (len(a), len(c)))
     def _update_hls(self, add, clear):
-        self._add_hls(nodes_to_hl(add))
-        self._clear_hls(nodes_to_hl(clear, clear=True))
+        """Add highlights of nodes `add` and remove those of nodes `clear`.
 
-    @debug_time(None, lambda _, nodes: '%d nodes' % len(nodes))
-    def _add_hls(self, node_or_nodes):
+        Highlights are removed by clearing whole lines, so the other drawn
+        nodes in those lines are highlighted again. The clears are sent
+        before the additions, in the same batch.
+        """
+        calls = []
+        ranges = clear_ranges(self._parser.changed, clear)
+        if ranges:
+            calls += self._clear_calls(ranges)
+            add = add + self._drawn_in_ranges(ranges, add)
+        calls += self._add_calls(nodes_to_hl(add, hl_ids=self._hl_ids))
+        self._call_atomic_async(calls)
+
+    def _drawn_in_ranges(self, ranges, add):
+        """Return nodes in the line `ranges` which are drawn, but not in
+        `add`."""
+        if ranges == [(0, -1)]:
+            # Only happens if all nodes were replaced, so all of them are
+            # either new or pending
+            return []
+        pending = self._pending_ids
+        add_ids = {n.id for n in add}
+        return [
+            node
+            for start, stop in ranges
+            for node in self._parser.nodes_in_lines(start + 1, stop)
+            if node.id not in pending and node.id not in add_ids
+        ]
+
+    @debug_time(None, lambda _, hls, ns=None: '%d nodes' % len(hls))
+    def _add_hls(self, hls, ns=None):
+        self._call_atomic_async(self._add_calls(hls, ns))
+
+    @debug_time(None, lambda _, ranges, ns=None: '%d ranges' % len(ranges))
+    def _clear_hls(self, ranges, ns=None):
+        self._call_atomic_async(self._clear_calls(ranges, ns))
+
+    def _add_calls(self, hls, ns=None):
+        """Return API calls adding highlights `hls` (as returned by
+        `nodes_to_hl()`) to namespace `ns`, by default the one of the node
+        highlights."""
         buf = self._buf
-        if not node_or_nodes:
-            return
-        if not isinstance(node_or_nodes, list):
-            buf.add_highlight(*node_or_nodes)
-            return
+        ns = self._ns if ns is None else ns
+        return [('nvim_buf_set_extmark', (buf, ns, *hl)) for hl in hls]
 
-        self._call_atomic_async(
-            [('nvim_buf_add_highlight', (buf, *n)) for n in node_or_nodes])
-
-    @debug_time(None, lambda _, nodes: '%d nodes' % len(nodes))
-    def _clear_hls(self, node_or_nodes):
+    def _clear_calls(self, ranges, ns=None):
+        """Return API calls clearing the line `ranges` (`start`, `stop`) of
+        namespace `ns`, by default the one of the node highlights."""
         buf = self._buf
-                
-        if not node_or_nodes:
-            return
-        if not isinstance(node_or_nodes, list):
-            self._wrap_async(buf.clear_highlight)(*node_or_nodes)
-            return
-        # Don't specify line range to clear explicitly because we can't
-        # reliably determine the correct range
-        self._call_atomic_async(
-            [('nvim_buf_clear_highlight', (buf, *n)) for n in node_or_nodes])
+        ns = self._ns if ns is None else ns
+        return [('nvim_buf_clear_namespace', (buf, ns, start, stop))
+                for start, stop in ranges]
 
     def _call_atomic_async(self, calls):
-        # Need to update in small batches to avoid
-        # https://github.com/neovim/python-client/issues/310
-        batch_size = 3000
         call_atomic = self._wrap_async(self._vim.api.call_atomic)
-        for i in range(0, len(calls), batch_size):
-            call_atomic(calls[i:i + batch_size], async_=True)
+        for batch in split_batches(calls):
+            call_atomic(batch, async_=True)
+            self._update_rpcs += 1
 
     def rename(self, cursor, new_name=None):
         """Rename node at `cursor` to `new_name`. If `new_name` is None, prompt
@@ -304,11 +652,11 @@ class BufferHandler:
         if cur_node is None:
             self._vim.out_write('Nothing to rename here.\n')
             return
-        nodes = list(self._parser.same_nodes(
+        nodes = self._parser.same_nodes(
             cur_node,
             mark_original=True,
             use_target=self._options.self_to_attribute,
-        ))
+        )
         num = len(nodes)
         if new_name is None:
             new_name = self._vim.eval('input("Rename %d nodes to: ")' % num)
@@ -331,23 +679,16 @@ class BufferHandler:
             self._buf[lineno - 1] = line
         self._vim.out_write('%d nodes renamed.\n' % num)
 
-    def goto(self, what, direction=None):
-        """Go to next location of type `what` in direction `direction`."""
+    def goto(self, what, direction=None, count=1):
+        """Go to the `count`th next location of type `what` in direction
+        `direction`."""
         if what == 'error':
             self._goto_error()
             return
-        
-        locs = self._parser.locations_by_hl_group(what)
-        
-        if not locs:
+        new_loc = self._parser.location_by_hl_group(
+            what, self._vim.current.window.cursor, direction, count)
+        if new_loc is None:
             return
-        
-        if direction == 'first':
-            new_loc = locs[0]
-        elif direction == 'last':
-            new_loc = locs[-1]
-        else:
-            new_loc = next_location(here, locs, (direction == 'prev'))
         try:
             self._vim.current.window.cursor = new_loc
         except neovim.api.NvimError:
@@ -377,29 +718,185 @@ class BufferHandler:
         self._vim.out_write('Syntax error: %s (%d, %d)\n' %
                             (error.msg, error.lineno, error.offset))
 
+    def persist(self):
+        """Store the nodes of the current buffer content in the disk cache
+        (if any)."""
+        self._parser.persist()
+
     def shutdown(self):
-        # Cancel the error timer so vim quits immediately
+        self._parser.persist()
+        # Drop the jobs still waiting for this buffer
+        for kind in ('update', 'viewport', 'error'):
+            self._worker.cancel((kind, self._buf_num))
+        self._closed = True
+        if self._update_task is not None:
+            self._update_task.cancel()
         if self._error_timer is not None:
             self._error_timer.cancel()
+        if self._shadow is not None and self._shadow.lines is not None:
+            try:
+                self._buf.api.detach()
+            except neovim.api.NvimError:
+                # The buffer is already gone
+                pass
+        if self._provider:
+            self._vim.exec_lua('require("denshi.provider").detach(...)',
+                               self._buf_num)
+        self._parser.close()
+
+
+class HighlightIds:
+    """Cache of the IDs of highlight groups.
+
+    Highlights refer to their group by ID rather than by name, which keeps
+    the names out of every highlight sent to Neovim. IDs which aren't known
+    yet are looked up in the background, the name is used until then.
+    """
+    def __init__(self, vim):
+        self._vim = vim
+        # Mapping (highlight group -> ID)
+        self._ids = {}
+        # Groups whose ID is known or being looked up
+        self._requested = set()
+
+    def __repr__(self):
+        return '<HighlightIds %d groups>' % len(self._ids)
+
+    def get(self, group):
+        """Return the ID of highlight group `group`, or `group` itself if it
+        isn't known yet."""
+        try:
+            return self._ids[group]
+        except KeyError:
+            pass
+        if group not in self._requested:
+            self._requested.add(group)
+            self._vim.async_call(self.refresh, [group])
+        return group
+
+    def refresh(self, groups):
+        """Look up the IDs of `groups`. Must be called from the main thread.
+        """
+        groups = list(groups)
+        self._requested.update(groups)
+        ids, error = self._vim.api.call_atomic(
+            [('nvim_get_hl_id_by_name', (g,)) for g in groups])
+        if error is not None:
+            logger.error('Failed to look up highlight group: %s', error[2])
+        self._ids.update(zip(groups, ids))
 
 
-def nodes_to_hl(nodes, clear=False, marked=False):
+def hl_group_id(hl_ids):
+    """Return function mapping highlight groups to their IDs from the
+    HighlightIds `hl_ids`, or to themselves if it's None."""
+    if hl_ids is None:
+        return lambda group: group
+    return hl_ids.get
+
+
+def nodes_to_hl(nodes, marked=False, hl_ids=None):
     """Convert list of nodes to highlight tuples which are the arguments to
-    neovim's add_highlight/clear_highlight APIs."""
-    if clear:
-        if marked:
-            return (Node.MARK_ID, 0, -1)
-        return [(n.id, 0, -1) for n in nodes]
+    neovim's nvim_buf_set_extmark() API (following buffer and namespace).
+
+    If HighlightIds `hl_ids` are given, highlight groups are passed by ID.
+    """
+    group_id = hl_group_id(hl_ids)
+    # Not strict, so a highlight of a line that has been shortened since the
+    # parse is cut off instead of failing the whole batch
     if marked:
-        id = Node.MARK_ID
-        return [(id, SELECTED, n.lineno - 1, n.col, n.end) for n in nodes]
-    return [(n.id, n.hl_group, n.lineno - 1, n.col, n.end) for n in nodes]
-
-
-def next_location(here, locs, reverse=False):
-    """Return the location of `locs` that comes after `here`."""
-    locs = locs[:]
-    if here not in locs:
-        locs.append(here)
-    locs = sorted(locs)
-    return locs[(locs.index(here) + (-1 if reverse else 1)) % len(locs)]
+        selected = group_id(SELECTED)
+        return [(n.lineno - 1, n.col, {
+            'end_col': n.end,
+            'hl_group': selected,
+            'priority': SELECTED_PRIORITY,
+            'strict': False,
+        }) for n in nodes]
+    return [(n.lineno - 1, n.col, {
+        'end_col': n.end,
+        'hl_group': group_id(n.hl_group),
+        'strict': False,
+    }) for n in nodes]
+
+
+def split_batches(calls, max_size=MAX_BATCH_SIZE):
+    """Yield the API calls `calls` in batches for call_atomic() requests of
+    `max_size` bytes at most (unless a single call is larger).
+
+    The msgpack sizes of all calls are added up, so batches of small calls
+    (like clearing namespaces) get larger than those of highlights. As
+    pynvim packs the calls anyway, they aren't packed here: the size of a
+    call is that of a sample call of the same method and shape, packed with
+    the largest integers. An options dict with other keys or a highlight
+    group name instead of an ID makes another shape.
+    """
+    packb = msgpack.packb
+    limit = max_size - REQUEST_PACKED_SIZE
+    # Packed size of the sample call of each shape
+    sizes = {}
+    batch = []
+    size = 0
+    for call in calls:
+        name, args = call
+        opts = args[-1]
+        if type(opts) is dict:
+            group = opts.get('hl_group')
+            shape = (name, len(args), len(opts),
+                     group if type(group) is str else None)
+        else:
+            shape = (name, len(args))
+        call_size = sizes.get(shape)
+        if call_size is None:
+            # The buffer (the first argument) is packed as a small ext type
+            call_size = sizes[shape] = BUFFER_PACKED_SIZE + len(
+                packb((name, sample_ints(args[1:]))))
+        if batch and size + call_size > limit:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(call)
+        size += call_size
+    if batch:
+        yield batch
+
+
+def sample_ints(value):
+    """Return `value` with all integers in it (recursively) replaced by
+    SAMPLE_INT."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return SAMPLE_INT
+    if isinstance(value, (list, tuple)):
+        return [sample_ints(v) for v in value]
+    if isinstance(value, dict):
+        return {k: sample_ints(v) for k, v in value.items()}
+    return value
+
+
+def clear_ranges(changed, nodes):
+    """Return the sorted line ranges (`start`, `stop`) (0-based, exclusive)
+    which need to be cleared to remove the highlights of `nodes`.
+
+    `changed` are the lines in which the parser replaced all nodes (see
+    `Parser.changed`), or None if it replaced all nodes in the buffer. The
+    removed nodes in there may have stale line numbers, so the whole range
+    is cleared.
+    """
+    if not nodes:
+        return []
+    if changed is None:
+        return [(0, -1)]
+    start, stop = changed
+    # Extmarks in deleted lines move to the line after them
+    lines = [(start, max(stop, start + 1))]
+    lines += [(n.lineno - 1, n.lineno) for n in nodes
+              if not start <= n.lineno - 1 < stop]
+    lines.sort()
+    ranges = [lines[0]]
+    for start, stop in lines[1:]:
+        last_start, last_stop = ranges[-1]
+        if start <= last_stop:
+            ranges[-1] = (last_start, max(last_stop, stop))
+        else:
+            ranges.append((start, stop))
+    return ranges
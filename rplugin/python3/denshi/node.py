@@ -7,18 +7,59 @@ SELECTED = 'denshiSelected'
 more_builtins = {'__file__', '__path__', '__cached__'}
 builtins = set(vars(builtins)) | more_builtins
 
+# Factors packing (line, column, group ID, name ID) into a single int
+KEY_LINENO = 1 << 96
+KEY_COL = 1 << 64
+KEY_GROUP = 1 << 32
+
+
+def pack_key(lineno, col, group_id, name_id):
+    """Return int which compares like the tuple of the arguments (which
+    must be smaller than 2**32)."""
+    return lineno * KEY_LINENO + col * KEY_COL + group_id * KEY_GROUP + \
+        name_id
+
+
+class StringIds:
+    """Mapping of highlight groups and names to the IDs packed into node
+    keys. Equal strings get equal IDs.
+
+    IDs are handed out in order and must fit in 32 bits. As the mapping
+    only grows, its owner replaces it once it holds many more strings than
+    are in use (see Parser._rekey()).
+    """
+    def __init__(self):
+        self._ids = {}
+
+    def __repr__(self):
+        return '<StringIds %d strings>' % len(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, string):
+        """Return the ID of `string`."""
+        ids = self._ids
+        try:
+            return ids[string]
+        except KeyError:
+            return ids.setdefault(string, len(ids))
+
+    def key(self, node):
+        """Return the packed key of `node`."""
+        return pack_key(node.lineno, node.col, self.get(node.hl_group),
+                        self.get(node.name))
+
 
 class Node:
     """A node in the source code.
 
     """
-    # Highlight ID for selected nodes
-    MARK_ID = 31400
-    # Highlight ID counter (chosen arbitrarily)
+    # Node ID counter (chosen arbitrarily)
     id_counter = count(314001)
 
     __slots__ = ['id', 'name', 'lineno', 'col', 'end', 'env',
-                 'symname', 'symbol', 'hl_group', 'target', '_tup']
+                 'symname', 'symbol', 'hl_group', 'target', '_tup', 'key']
 
     def __init__(self, name, lineno, col, end, hl_group):
         self.id = next(Node.id_counter)
@@ -28,11 +69,21 @@ class Node:
         # Encode the name to get the byte length, not the number of chars
         self.end = end
         self.hl_group = hl_group
+        # Packed key used for diffing, which the owner of the node assigns
+        # with its StringIds. Equal nodes have equal keys, but keys order
+        # nodes at the same position by the IDs of group and name, not by
+        # the strings.
+        self.key = None
         self.update_tup()
 
     def update_tup(self):
-        """Update tuple used for comparing with other nodes."""
+        """Update tuple used for comparing with other nodes, and the packed
+        key (if the node has one)."""
         self._tup = (self.lineno, self.col, self.hl_group, self.name)
+        if self.key is not None:
+            # Keep the IDs of group and name in the low bits
+            self.key = pack_key(self.lineno, self.col, 0, 0) + \
+                self.key % KEY_COL
 
     def __lt__(self, other):
         return self._tup < other._tup # pylint: disable=protected-access
@@ -1,12 +1,26 @@
 from collections import deque
 from collections.abc import Iterable
 from functools import singledispatch
-from .util import debug_time, logger, lines_to_code, code_to_lines
-from .node import Node
+from itertools import chain
+from operator import attrgetter, eq
+from .cache import cache_key, parser_identity
+from .util import debug_time, logger, lines_to_code, code_to_lines, \
+    merge_hunks, NO_CHANGE
+from .node import StringIds
+from .session import SessionCancelled, SessionCrashed, SessionError, \
+    SessionUnavailable
+from .store import NodeStore
+from .table import NodeTable
+from .transport import make_transport
 
+import asyncio
 import subprocess
-import tempfile
-from threading import Lock
+from threading import Event, Lock
+
+# Number of unused strings the string IDs of a parser may hold on top of
+# the strings of the last parse result, before they're rebuilt
+STRING_IDS_SLACK = 4096
+
 
 class UnparsableError(Exception):
 
@@ -15,16 +29,27 @@ class UnparsableError(Exception):
         self.error = error
 
 
+class ParseCancelled(Exception):
+    """The parse was cancelled because newer code is waiting to be parsed."""
+
+
 class Parser:
     """The parser parses Python code and generates source code nodes. For every
     run of `parse()` on changed source code, it returns the nodes that have
     been added and removed.
     """
-    def __init__(self, config_location, binary_location, exclude=None, fix_syntax=True):
+    def __init__(self, config_location, binary_location, exclude=None,
+                 fix_syntax=True, session=None, transport='stdin',
+                 cache=None, diff_window=-1):
         self._excluded = exclude or []
         self._fix_syntax = fix_syntax
         self._locations = {}
-        self._nodes = []
+        self._nodes = NodeStore()
+        # IDs of the strings packed into the keys of the nodes
+        self._string_ids = StringIds()
+        # Guards the node store, which is updated in place by the parsing
+        # thread while the main thread looks up nodes.
+        self._nodes_lock = Lock()
         self.lines = []
         # Incremented after every parse call
         self.tick = 0
@@ -32,6 +57,34 @@ class Parser:
     
         self.binary_location = binary_location
         self.config_location = config_location
+        # Optional denshi.session.ParserSession shared between parsers
+        self._session = session
+        # How the code is handed to the binary when there is no session
+        self._transport = make_transport(transport)
+        # Optional denshi.cache.ParseCache shared between parsers, and the
+        # cache key of the code of the last parse
+        self._cache = cache
+        self._last_key = None
+        # Number of lines around a changed hunk in which nodes are diffed,
+        # or -1 to diff the nodes in all lines
+        self._diff_window = diff_window
+        # State of the parser run in progress, guarded by _run_lock so that
+        # cancel() can be called from another thread.
+        self._run_lock = Lock()
+        self._running = False
+        self._cancelled = False
+        self._proc = None
+        # Event interrupting the session request of the run in progress
+        self._session_cancel = None
+        # Number of parses which were cancelled by cancel()
+        self.superseded = 0
+        # Lines (`start`, `stop`) of the code of the last parse (0-based,
+        # exclusive) in which all nodes were replaced, or None if all nodes
+        # in the buffer were replaced
+        self.changed = None
+        # Hunk of changes from `lines` to the code of failed parse calls,
+        # or None if unknown
+        self._unparsed_hunk = NO_CHANGE
         # Holds the error of the current and previous run, so the buffer
         # handler knows if error signs need to be updated.
         self.syntax_errors = deque([None, None], maxlen=2)
@@ -56,188 +109,474 @@ class Parser:
     def _filter_excluded(self, nodes):
         return [n for n in nodes if n.hl_group not in self._excluded]
 
-    def _parse(self, code, force=False):
+    async def parse_async(self, code, force=False, hunk=None, session=None):
+        """Like `parse()`, but the parser runs as an asyncio subprocess, or
+        as a request to the denshi.pipeline.AsyncParserSession `session`.
+
+        Cancelling the awaiting task cancels the parse.
+        """
+        key, table = self._cached_table(code)
+        if table is None:
+            try:
+                output = await self._run_async(code, session)
+            except BaseException as e:
+                self._skip(code, hunk)
+                if isinstance(e, asyncio.CancelledError):
+                    self.superseded += 1
+                    logger.debug('[%d] parse superseded', self.tick)
+                raise
+            table = self._decode(output)
+            self._cache_table(key, table)
+        return self.parse(code, force, hunk, table=table)
+
+    def _skip(self, code, hunk):
+        """Remember the changes in `code` which failed to parse, so the next
+        parse includes them."""
+        with self.parse_lock:
+            new_lines = code_to_lines(code)
+            self._unparsed_hunk = self._exact_hunk(hunk, self.lines,
+                                                   new_lines)
+        self.tick += 1
+
+    def _parse(self, code, force=False, hunk=None, table=None):
         
         with self.parse_lock:
             """Parse code and return tuple (`add`, `remove`) of added and removed
             nodes since last run. With `force`, all highlights are refreshed, even
-            those that didn't change.
+            those that didn't change. If the caller knows which lines changed
+            since the previous call, it passes them as `hunk` so we don't need
+            to compare all lines. Without it, all nodes are replaced if the
+            number of lines changed.
             """
             self._locations.clear()
             old_lines = self.lines
             new_lines = code_to_lines(code)
-            minor_change, change_lineno = self._minor_change(old_lines, new_lines)
-            old_nodes = self._nodes
-            
-
-            new_nodes = self._make_nodes(code, new_lines, change_lineno)
-            # Detecting minor changes keeps us from updating a lot of highlights
-            # while the user is only editing a single line.
-            if minor_change and not force:
-                add, rem, keep = self._diff(old_nodes, new_nodes)
-                self._nodes = keep + add
-            else:
-                add, rem = new_nodes, old_nodes
-                self._nodes = add
+            hunk = self._exact_hunk(hunk, old_lines, new_lines)
+            try:
+                if table is None:
+                    table = self._make_table(code)
+            except BaseException:
+                # The next call's hunk needs to include these changes
+                self._unparsed_hunk = hunk
+                raise
+            self._unparsed_hunk = NO_CHANGE
+            # Only re-emitting the nodes in the changed hunk keeps us from
+            # updating a lot of highlights while the user is only editing a
+            # few lines.
+            with self._nodes_lock:
+                if not force and hunk is not None:
+                    add, rem = self._update_nodes(table, hunk)
+                    self.changed = (hunk[0], hunk[2])
+                else:
+                    # All nodes are new, so their keys can use new IDs
+                    self._string_ids = StringIds()
+                    add = table.nodes(keys=table.keys(self._string_ids))
+                    rem = list(self._nodes)
+                    self._nodes = NodeStore(add)
+                    self.changed = None
 
         # Only assign new lines when nodes have been updated accordingly
         self.lines = new_lines
         logger.debug('[%d] nodes: +%d,  -%d', self.tick, len(add), len(rem))
         return (self._filter_excluded(add), self._filter_excluded(rem))
 
-    def _make_nodes(self, code, lines=None, change_lineno=None):
-        """Return nodes in code.
+    def _make_table(self, code):
+        """Return NodeTable of the nodes in `code`."""
+        key, table = self._cached_table(code)
+        if table is None:
+            table = self._decode(self._run(code))
+            self._cache_table(key, table)
+        return table
+
+    def _cached_table(self, code):
+        """Return tuple (`key`, `table`) of the cache key of `code` and the
+        NodeTable cached for it, or (None, None) without cache."""
+        cache = self._cache
+        if cache is None:
+            return None, None
+        key = cache_key(code, parser_identity(self.binary_location,
+                                              self.config_location))
+        self._last_key = key
+        return key, cache.get(key)
+
+    def _cache_table(self, key, table):
+        """Store NodeTable `table` for cache key `key`.
+
+        Only the table of the first parse goes to the disk cache right away,
+        the others only once persist() is called, so typing doesn't write a
+        file per keystroke.
+        """
+        if key is not None:
+            self._cache.put(key, table, persist=self.tick == 0)
+
+    def persist(self):
+        """Store the nodes of the last parse in the disk cache (if any),
+        e.g. when the buffer is left."""
+        if self._cache is not None and self._last_key is not None:
+            self._cache.persist(self._last_key)
+
+    @staticmethod
+    def _decode(output):
+        """Return NodeTable of the node records in the parser output
+        `output`."""
+        return NodeTable.decode(output)
+
+    def _run(self, code):
+        """Run the parser binary on `code` and return its output.
 
-        Runs AST visitor on code and produces nodes. We're passing both code
-        *and* lines around to avoid lots of conversions.
+        Uses the persistent session if there is one, and falls back to
+        spawning a process for this parse if the session is gone or crashed
+        on `code`.
+
+        Raises ParseCancelled() if cancel() was called during the run.
         """
-        if lines is None:
-            lines = code_to_lines(code)
-
-        #FIXME tempfile used - I'm sure there's a more 
-        #      vim way of getting a file from the underlying buffer 
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp_file:
-            tmp_file.write(code)
-            tmp_file.flush()
-            
-            #tmp_file.seek(0)
-            #assert tmp_file.readlines() != [], "File should be readable"
-            args = [self.binary_location, 
-                    str(tmp_file.name),
+        with self._run_lock:
+            self._running = True
+            self._cancelled = False
+            self._session_cancel = Event()
+        try:
+            output = self._run_session(code)
+            if output is None:
+                output = self._run_once(code)
+        finally:
+            with self._run_lock:
+                self._running = False
+                self._proc = None
+                self._session_cancel = None
+                cancelled = self._cancelled
+        if cancelled:
+            self.superseded += 1
+            logger.debug('[%d] parse superseded', self.tick)
+            raise ParseCancelled()
+        return output
+
+    def _run_session(self, code):
+        """Return output of the session for `code`, or None if there is no
+        usable session."""
+        session = self._session
+        if session is None or not session.available:
+            return None
+        try:
+            return session.parse(code, self._session_cancel)
+        except SessionCancelled:
+            # Discarded, as cancel() was called
+            return ''
+        except SessionCrashed:
+            logger.debug('[%d] parser session crashed, parsing with a '
+                         'single run', self.tick)
+            return None
+        except SessionError as e:
+            raise UnparsableError(e)
+        except SessionUnavailable:
+            logger.error('Parser session unavailable, falling back to '
+                         'one process per parse.')
+            return None
+
+    def _run_once(self, code):
+        with self._transport.handoff(code) as (path, stdin, pass_fds):
+            args = [self.binary_location,
+                    path,
                     self.config_location,
                     "parse"]
-    
-   
-            popen = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            popen.wait()
-            output = popen.stdout.read()       
-            err_out = popen.stderr.read()
-
-        assert err_out == "", f"Parser return errors: Parser output: \n{err_out}  \nCalled with: {str(args)}"
-  
-        nodes = []
-        for line in output.split("\n"):
-            s = line.split(" ")
-            if len(s) == 1: #Because s = ['']
-                continue
-            group = s[0]
-            line = int(s[1])
-            start = int(s[2])
-            end = int(s[3])
-            name = s[4]
-            nodes.append(Node(name, line, start, end, group))
-
-        return nodes
+            popen = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                pass_fds=pass_fds,
+            )
+            with self._run_lock:
+                self._proc = popen
+                if self._cancelled:
+                    popen.kill()
+            # Read the pipes while waiting so large outputs can't deadlock
+            output, err_out = popen.communicate(stdin)
+        # If the process was killed, the output is incomplete and gets
+        # discarded by _run() anyway
+        if not self._cancelled:
+            assert err_out == "", f"Parser return errors: Parser output: \n{err_out}  \nCalled with: {str(args)}"
+        return output
+
+    async def _run_async(self, code, session):
+        """Return the output of the parser on `code`, like `_run()`."""
+        if session is not None and session.available:
+            try:
+                return await session.parse(code)
+            except SessionCrashed:
+                logger.debug('[%d] parser session crashed, parsing with a '
+                             'single run', self.tick)
+            except SessionError as e:
+                raise UnparsableError(e)
+            except SessionUnavailable:
+                logger.error('Parser session unavailable, falling back to '
+                             'one process per parse.')
+        with self._transport.handoff(code) as (path, stdin, pass_fds):
+            args = [self.binary_location,
+                    path,
+                    self.config_location,
+                    "parse"]
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=(subprocess.DEVNULL if stdin is None else
+                       subprocess.PIPE),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=pass_fds,
+            )
+            try:
+                output, err_out = await proc.communicate(
+                    None if stdin is None else stdin.encode('utf-8'))
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+        err_out = err_out.decode('utf-8')
+        assert err_out == "", (f"Parser return errors: Parser output: \n"
+                               f"{err_out}  \nCalled with: {str(args)}")
+        return output.decode('utf-8')
+
+    def cancel(self):
+        """Cancel the parser run in progress (if any).
+
+        A one-shot process is killed right away. A request to the session
+        is abandoned (the session process discards its response and serves
+        the next request), and a request still waiting for the session
+        isn't sent. Either way, the pending `parse()` raises
+        ParseCancelled().
+        """
+        with self._run_lock:
+            if not self._running:
+                return
+            self._cancelled = True
+            if self._proc is not None:
+                self._proc.kill()
+            if self._session is not None:
+                self._session.interrupt(self._session_cancel)
+
+    def close(self):
+        """Release the resources held by the transport."""
+        self._transport.close()
+
+    def _hunk_since_lines(self, hunk, old_lines, new_lines):
+        """Return the hunk of changes from `old_lines` (the lines of the last
+        successful parse) to `new_lines`, given the hunk `hunk` of changes
+        since the previous call. Return None if it's unknown.
+        """
+        if hunk is None or self._unparsed_hunk is None:
+            return None
+        hunk = merge_hunks(self._unparsed_hunk, hunk)
+        start, old_stop, new_stop = hunk
+        if old_stop > len(old_lines) or \
+           len(new_lines) - len(old_lines) != new_stop - old_stop:
+            logger.debug('hunk %s inconsistent with lines', hunk)
+            return None
+        return hunk
+
+    def _exact_hunk(self, hunk, old_lines, new_lines):
+        """Return the hunk of changes from `old_lines` to `new_lines`, given
+        the hunk `hunk` of changes since the previous call (or None), or None
+        if the changed lines can't be located exactly.
+
+        Without a known hunk, the lines which differ are only unambiguous if
+        the number of lines didn't change. Otherwise, an insertion in a run
+        of equal lines could be anywhere in it, so nodes can't be shifted.
+        """
+        exact = self._hunk_since_lines(hunk, old_lines, new_lines)
+        if exact is None and len(old_lines) == len(new_lines):
+            exact = self._changed_hunk(old_lines, new_lines)
+        return exact
 
     @staticmethod
-    def _minor_change(old_lines, new_lines):
-        """Determine whether a minor change between old and new lines occurred.
-        Return (`minor_change`, `change_lineno`) where `minor_change` is True
-        when at most one change occurred and `change_lineno` is the line number
-        of the change.
-
-        A minor change is a change in a single line while the total number of
-        lines doesn't change.
+    def _changed_hunk(old_lines, new_lines):
+        """Return the hunk (`start`, `old_stop`, `new_stop`) of lines which
+        differ between `old_lines` and `new_lines`.
+
+        Lines before `start` and the lines after `old_stop` (or `new_stop`,
+        respectively) are the same in both.
         """
-        if len(old_lines) != len(new_lines):
-            # A different number of lines doesn't count as minor change
-            return (False, None)
-        old_iter = iter(old_lines)
-        new_iter = iter(new_lines)
-        diff_lineno = None
-        lineno = 0
-        try:
-            while True:
-                old_lines = next(old_iter)
-                new_lines = next(new_iter)
-                if old_lines != new_lines:
-                    if diff_lineno is not None:
-                        # More than one change must have happened
-                        return (False, None)
-                    diff_lineno = lineno
-                lineno += 1
-        except StopIteration:
-            # We iterated through all lines with at most one change
-            return (True, diff_lineno)
+        old_stop = len(old_lines)
+        new_stop = len(new_lines)
+        stop = min(old_stop, new_stop)
+        start = 0
+        while start < stop and old_lines[start] == new_lines[start]:
+            start += 1
+        while old_stop > start and new_stop > start and \
+                old_lines[old_stop - 1] == new_lines[new_stop - 1]:
+            old_stop -= 1
+            new_stop -= 1
+        return (start, old_stop, new_stop)
+
+    @debug_time
+    def _update_nodes(self, table, hunk):
+        """Update the current nodes to those of NodeTable `table` after the
+        lines in `hunk` changed and return tuple (`add`, `remove`) of added
+        and removed nodes.
+
+        Old nodes in the changed lines are always removed and new nodes in
+        the changed lines are always added. Old nodes below the hunk are
+        shifted by the number of inserted or deleted lines, then all nodes
+        outside of the hunk are diffed (because a change can affect the
+        highlights of other lines). With a diff window, only the nodes in the
+        lines that close to the hunk are diffed, the others are kept as they
+        are. Nodes are only created for added rows of the table.
+        """
+        start, old_stop, new_stop = hunk
+        store = self._nodes
+        rem_inside = store.pop_lines(start + 1, old_stop + 1)
+        store.shift(old_stop + 1, new_stop - old_stop)
+        inside = table.line_rows(start + 1, new_stop)
+        if self._diff_window < 0:
+            old = list(store)
+            outside = chain(range(inside.start),
+                            range(inside.stop, len(table)))
+            keys = table.keys(self._string_ids)
+        else:
+            # Line numbers of the first and last line of the window
+            first = max(start + 1 - self._diff_window, 1)
+            last = new_stop + self._diff_window
+            old = store.in_lines(first, last)
+            outside = [*table.line_rows(first, start),
+                       *table.line_rows(new_stop + 1, last)]
+            # Only the rows in the window need keys
+            keys = table.keys(self._string_ids, chain(outside, inside))
+        add, rem = self._diff(old, table, outside, keys)
+        store.remove(rem)
+        add += table.nodes(inside, keys)
+        store.add(add)
+        if len(self._string_ids) > 2 * len(table.strings) + STRING_IDS_SLACK:
+            self._rekey()
+        return add, rem + rem_inside
+
+    def _rekey(self):
+        """Replace the string IDs by IDs of only the strings in use, and
+        update the keys of all nodes."""
+        ids = StringIds()
+        for node in self._nodes:
+            node.key = ids.key(node)
+        self._string_ids = ids
 
     @staticmethod
     @debug_time
-    def _diff(old_nodes, new_nodes):
-        """Return difference between iterables of nodes old_nodes and new_nodes
-        as three lists of nodes to add, remove and keep.
+    def _diff(old_nodes, table, rows, keys):
+        """Return difference between the nodes `old_nodes` and the rows
+        `rows` of NodeTable `table` as tuple (`add`, `remove`) of new nodes
+        for the rows which have no equal old node, and of old nodes which
+        have no equal row, both in order of their keys.
+
+        Old nodes which have an equal row are kept, so they keep their
+        highlight IDs. Nodes and rows are sorted and compared by their
+        packed int keys, `keys` being those of the rows (see
+        NodeTable.keys()). The common start and end of both are found with
+        element-wise comparisons in C, so only the keys in between are
+        merged in Python.
         """
-        add_iter = iter(sorted(new_nodes))
-        rem_iter = iter(sorted(old_nodes))
-        add_nodes = []
+        old_nodes = sorted(old_nodes, key=attrgetter('key'))
+        old_keys = list(map(attrgetter('key'), old_nodes))
+        rows = sorted(rows, key=keys.__getitem__)
+        new_keys = list(map(keys.__getitem__, rows))
+        if old_keys == new_keys:
+            return [], []
+        start = _common_prefix(old_keys, new_keys)
+        old_stop = len(old_keys)
+        new_stop = len(new_keys)
+        end = _common_prefix(reversed(old_keys[start:]),
+                             reversed(new_keys[start:]))
+        old_stop -= end
+        new_stop -= end
+        add_rows = []
         rem_nodes = []
-        keep_nodes = []
-        try:
-            add = rem = None
-            while True:
-                if add == rem:
-                    if add is not None:
-                        keep_nodes.append(add)
-                        # A new node needs to adopt the highlight ID of
-                        # corresponding currently highlighted node
-                        add.id = rem.id
-                    add = rem = None
-                    add = next(add_iter)
-                    rem = next(rem_iter)
-                elif add < rem:
-                    add_nodes.append(add)
-                    add = None
-                    add = next(add_iter)
-                elif rem < add:
-                    rem_nodes.append(rem)
-                    rem = None
-                    rem = next(rem_iter)
-        except StopIteration:
-            if add is not None:
-                add_nodes.append(add)
-            if rem is not None:
-                rem_nodes.append(rem)
-            add_nodes += list(add_iter)
-            rem_nodes += list(rem_iter)
-        return add_nodes, rem_nodes, keep_nodes
+        i = start
+        for j in range(start, new_stop):
+            key = new_keys[j]
+            while i < old_stop and old_keys[i] < key:
+                rem_nodes.append(old_nodes[i])
+                i += 1
+            if i < old_stop and old_keys[i] == key:
+                i += 1
+            else:
+                add_rows.append(rows[j])
+        rem_nodes += old_nodes[i:old_stop]
+        return table.nodes(add_rows, keys), rem_nodes
 
     @debug_time
     def node_at(self, cursor):
         """Return node at cursor position."""
         lineno, col = cursor
-        for node in self._nodes:
-            if node.lineno == lineno and node.col <= col < node.end:
-                return node
-        return None
+        with self._nodes_lock:
+            return self._nodes.at(lineno, col)
+
+    def nodes_in_lines(self, start, stop):
+        """Return nodes in the lines `start` to `stop` (inclusive), except
+        those in excluded highlight groups."""
+        with self._nodes_lock:
+            nodes = self._nodes.in_lines(start, stop)
+        return self._filter_excluded(nodes)
+
+    def all_nodes(self):
+        """Return all nodes, except those in excluded highlight groups."""
+        with self._nodes_lock:
+            nodes = list(self._nodes)
+        return self._filter_excluded(nodes)
 
     # pylint: disable=method-hidden
-    def same_nodes(self, cur_node, mark_original=True, use_target=True):
+    def same_nodes(self, cur_node, mark_original=True, use_target=True,
+                   view=None):
         """Return nodes with the same scope as cur_node.
 
         The same scope is to be understood as all nodes with the same base
-        symtable. In some cases this can be ambiguous.
+        symtable. In some cases this can be ambiguous. If `view` is a tuple
+        (`start`, `stop`), only nodes in those lines (inclusive) are returned.
         """
         if use_target:
-            target = cur_node.hl_group
+            target = getattr(cur_node, 'target', None)
             if target is not None:
                 cur_node = target
-        cur_name = cur_node.name
         base_table = cur_node.base_table()
-        for node in self._nodes:
-            if node.name != cur_name:
-                continue
-            if not mark_original and node is cur_node:
-                continue
-            if node.base_table() == base_table:
-                yield node
-
-    def _same_nodes_cursor(self, cursor, mark_original=True, use_target=True):
+        with self._nodes_lock:
+            nodes = self._nodes.by_name(cur_node.name, *(view or ()))
+        return [
+            node for node in nodes
+            if (mark_original or node is not cur_node) and
+            node.base_table() == base_table
+        ]
+
+    def _same_nodes_cursor(self, cursor, mark_original=True, use_target=True,
+                           view=None):
         """Return nodes with the same scope as node at the cursor position."""
         cur_node = self.node_at(cursor)
         if cur_node is None:
             return []
-        return self.same_nodes(cur_node, mark_original, use_target)
+        return self.same_nodes(cur_node, mark_original, use_target, view)
 
     def locations_by_hl_group(self, group):
         """Return locations of all nodes whose highlight group is `group`."""
-        return [n.pos for n in self._nodes if n.hl_group == group]
+        with self._nodes_lock:
+            return [n.pos for n in self._nodes.by_group(group)]
+
+    def location_by_hl_group(self, group, cursor, direction='next', count=1):
+        """Return location of a node whose highlight group is `group`, or
+        None if there is none.
+
+        With `direction` 'next' or 'prev', it's the `count`th node after or
+        before `cursor` (wrapping around), with 'first' or 'last' the first
+        or last node in the buffer.
+        """
+        with self._nodes_lock:
+            if direction in ('first', 'last'):
+                node = self._nodes.group_end(group, direction == 'last')
+            else:
+                offset = -count if direction == 'prev' else count
+                node = self._nodes.group_neighbor(group, *cursor, offset)
+        if node is None:
+            return None
+        return node.pos
+
 
+def _common_prefix(a, b):
+    """Return length of the common prefix of the iterables `a` and `b`."""
+    equal = list(map(eq, a, b))
+    try:
+        return equal.index(False)
+    except ValueError:
+        return len(equal)
@@ -0,0 +1,278 @@
+"""Building blocks of the update pipeline running on the event loop of
+pynvim (see `g:denshi#asyncio`).
+
+Instead of handing work between threads, the handlers run their updates as
+asyncio tasks on the loop which also handles the RPC messages of Neovim. The
+parser runs as an asyncio subprocess, requests to Neovim are awaited instead
+of blocking a thread, and delays are asyncio timers.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from heapq import heappop, heappush
+from itertools import count
+
+try:
+    from pynvim.api.common import walk
+except ImportError:
+    from neovim.api.common import walk
+
+from .session import (DRAIN_TIMEOUT, SessionError, SessionHealth,
+                      SessionUnavailable)
+from .util import logger
+from .worker import RANK_CURRENT
+
+
+class AsyncNvim:
+    """Sends requests to Neovim whose results are awaited on the loop.
+
+    Must only be used from the loop thread.
+    """
+    def __init__(self, vim):
+        self._vim = vim
+
+    def request(self, name, *args):
+        """Send API request `name` with `args` and return a future of its
+        result."""
+        vim = self._vim
+        # pylint: disable=protected-access
+        session = vim._session
+        future = vim.loop.create_future()
+
+        def response_cb(err, result):
+            if future.cancelled():
+                return
+            if err:
+                future.set_exception(session.error_wrapper(err))
+            else:
+                future.set_result(walk(vim._from_nvim, result))
+        session._async_session.request(name, walk(vim._to_nvim, args),
+                                       response_cb)
+        return future
+
+
+class AsyncParserSession(SessionHealth):
+    """A persistent parser process talking the protocol of
+    denshi.session.ParserSession, driven by asyncio.
+
+    Requests are serialized with an asyncio lock. Cancelling the caller of
+    a request in progress abandons the request: a task reads and discards
+    its response, and the process serves the next request. Only if the
+    response doesn't arrive within `drain_timeout` seconds, the process is
+    killed and restarted for the next request.
+    """
+    def __init__(self, binary_location, config_location, max_restarts=3,
+                 retry_after=60., drain_timeout=DRAIN_TIMEOUT):
+        super().__init__(max_restarts, retry_after)
+        self.drain_timeout = drain_timeout
+        self._args = [binary_location, '<placeholder>', config_location,
+                      'serve']
+        self._proc = None
+        self._lock = asyncio.Lock()
+        # Header of the response in flight, once it's read
+        self._header = None
+        # Task discarding the response to an abandoned request
+        self._draining = None
+        # Number of times the process was (re)started
+        self.starts = 0
+        # Number of requests abandoned by cancelling their caller
+        self.abandoned = 0
+
+    def __repr__(self):
+        return ('<AsyncParserSession pid=%s starts=%d abandoned=%d '
+                'available=%s>' % (
+                    self._proc.pid if self._proc is not None else None,
+                    self.starts,
+                    self.abandoned,
+                    self.available,
+                ))
+
+    async def parse(self, code):
+        """Return the node records for `code` as a string.
+
+        Raises SessionError if the parser rejected the code (SessionCrashed
+        if it died on it) and SessionUnavailable if there is no usable
+        process, or if no process ever answered.
+        """
+        return await self._parse(code.encode('utf-8'))
+
+    async def _parse(self, data):
+        async with self._lock:
+            if self._draining is not None:
+                await asyncio.shield(self._draining)
+            # Like ParserSession.parse()
+            for retry in (True, False):
+                if not self.available:
+                    raise SessionUnavailable()
+                fresh = self._proc is None or self._proc.returncode is not None
+                try:
+                    proc = await self._ensure_started()
+                except OSError as e:
+                    logger.error('Failed to start parser session: %s', e)
+                    self.available = False
+                    raise SessionUnavailable()
+                try:
+                    result = await self._request(proc, data)
+                except asyncio.CancelledError:
+                    self.abandoned += 1
+                    self._draining = asyncio.ensure_future(self._drain(proc))
+                    raise
+                except (OSError, EOFError, ValueError) as e:
+                    await self._kill()
+                    if retry and not fresh:
+                        continue
+                    raise self._crashed(data, e)
+                self._succeeded()
+                return result
+
+    async def close(self):
+        await self._kill()
+
+    async def _ensure_started(self):
+        if self._proc is None or self._proc.returncode is not None:
+            self._proc = await asyncio.create_subprocess_exec(
+                *self._args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            self.starts += 1
+        return self._proc
+
+    async def _request(self, proc, data):
+        proc.stdin.write(b'parse %d\n' % len(data))
+        proc.stdin.write(data)
+        await proc.stdin.drain()
+        status, payload = await self._read_response(proc)
+        payload = payload.decode('utf-8')
+        if status == b'error':
+            raise SessionError(payload)
+        return payload
+
+    async def _read_response(self, proc):
+        """Read the response to the request in flight and return its status
+        and payload. Can be cancelled and called again to continue."""
+        if self._header is None:
+            header = await proc.stdout.readline()
+            if not header.endswith(b'\n'):
+                raise EOFError('parser session closed the connection')
+            self._header = header
+        status, length = self._header.split()
+        if status not in (b'ok', b'error'):
+            raise ValueError('unexpected response header: %r' % self._header)
+        try:
+            payload = await proc.stdout.readexactly(int(length))
+        except asyncio.IncompleteReadError:
+            raise EOFError('parser session sent a truncated response')
+        self._header = None
+        return status, payload
+
+    async def _drain(self, proc):
+        """Discard the response to an abandoned request, or kill the process
+        if it doesn't arrive within `drain_timeout`."""
+        try:
+            await asyncio.wait_for(self._read_response(proc),
+                                   self.drain_timeout)
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+            logger.debug('dropping parser session with abandoned request: '
+                         '%r', e)
+            if self._proc is proc:
+                await self._kill()
+        finally:
+            self._draining = None
+
+    async def _kill(self):
+        proc = self._proc
+        self._proc = None
+        self._header = None
+        if proc is None:
+            return
+        proc.stdin.close()
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+
+
+class ParseSlots:
+    """Limits the number of parses running at the same time to `limit`.
+
+    Parses waiting for a slot get one in order of the rank of their buffer.
+    Idle parses only get one while no other parse is running.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        # Number of slots in use
+        self.used = 0
+        # Heap of (`rank`, `seq`, `idle`, `future`) of waiting parses
+        self._waiting = []
+        self._seq = count()
+
+    def __repr__(self):
+        return '<ParseSlots %d / %d used, %d waiting>' % (
+            self.used, self.limit, len(self._waiting))
+
+    @asynccontextmanager
+    async def slot(self, rank=RANK_CURRENT, idle=False):
+        """Hold a slot while in the context."""
+        await self.acquire(rank, idle)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, rank=RANK_CURRENT, idle=False):
+        """Wait for a slot."""
+        if not self._waiting and self._free(idle):
+            self.used += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heappush(self._waiting, (rank, next(self._seq), idle, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Cancelled after getting the slot
+                self.release()
+            raise
+
+    def release(self):
+        self.used -= 1
+        self._wake()
+
+    def _free(self, idle):
+        return self.used < self.limit and not (idle and self.used)
+
+    def _wake(self):
+        skipped = []
+        while self._waiting and self.used < self.limit:
+            entry = heappop(self._waiting)
+            _, _, idle, future = entry
+            if future.cancelled():
+                continue
+            if not self._free(idle):
+                skipped.append(entry)
+                continue
+            self.used += 1
+            future.set_result(None)
+        for entry in skipped:
+            heappush(self._waiting, entry)
+
+
+class AsyncPipeline:
+    """The pieces of the asyncio update pipeline shared by all handlers."""
+    def __init__(self, vim, options):
+        self.loop = vim.loop
+        self.nvim = AsyncNvim(vim)
+        self.session = None
+        if options.parser_session:
+            self.session = AsyncParserSession(options.binary_location,
+                                              options.config_location)
+        self.slots = ParseSlots(max(1, options.max_parsers))
+
+    def __repr__(self):
+        return '<AsyncPipeline %r %r>' % (self.session, self.slots)
+
+    def close(self):
+        """Stop the session process. It also exits by itself when the host
+        exits before, as its stdin is closed then."""
+        if self.session is not None:
+            self.loop.create_task(self.session.close())
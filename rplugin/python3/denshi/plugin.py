@@ -1,11 +1,17 @@
 from functools import partial, wraps
+import os
 
 try:
     import pynvim as neovim
 except ImportError:
     import neovim
 
-from .handler import BufferHandler
+from .cache import DiskCache, ParseCache
+from .handler import BufferHandler, HighlightIds
+from .node import SELECTED
+from .pipeline import AsyncPipeline
+from .session import ParserSession
+from .worker import RANK_CURRENT, RANK_HIDDEN, RANK_VISIBLE, UpdateWorker
 
 import subprocess
 
@@ -51,6 +57,22 @@ class Plugin:
         # The currently active buffer handler
         self._cur_handler = None
         self._options = None
+        # The parser process shared by all handlers (if enabled)
+        self._session = None
+        # The parse result cache shared by all handlers (if enabled)
+        self._cache = None
+        # "hi def" commands from the parser config, and the (path, mtime) of
+        # the config they were generated from
+        self._hl_commands = []
+        self._hl_commands_stamp = None
+        # The highlight groups defined by those commands
+        self._hl_groups = []
+        # IDs of highlight groups, shared by all handlers
+        self._hl_ids = None
+        # The threads running the updates of all handlers
+        self._worker = None
+        # The asyncio update pipeline shared by all handlers (if enabled)
+        self._pipeline = None
 
     def _init_with_vim(self):
         """Initialize with vim available.
@@ -59,6 +81,31 @@ class Plugin:
         __init__ because vim itself may not be fully started up.
         """
         self._options = Options(self._vim)
+        self._hl_ids = HighlightIds(self._vim)
+        self._worker = UpdateWorker(max(1, self._options.max_parsers),
+                                    self._vim.async_call)
+        if self._options.asyncio:
+            # Its session process serves all parses on the loop. The few
+            # synchronous ones (like ":Denshi highlight") run the parser
+            # once each rather than keeping a second process around.
+            self._pipeline = AsyncPipeline(self._vim, self._options)
+        elif self._options.parser_session:
+            self._session = ParserSession(self._options.binary_location,
+                                          self._options.config_location)
+        disk_cache = None
+        if self._options.parse_cache_dir:
+            disk_cache = DiskCache(
+                os.path.expanduser(self._options.parse_cache_dir),
+                int(self._options.parse_cache_dir_size * 1024 * 1024))
+        if self._options.parse_cache_size > 0 or disk_cache is not None:
+            self._cache = ParseCache(
+                int(self._options.parse_cache_size * 1024 * 1024),
+                disk=disk_cache)
+        if self._options.decoration_provider:
+            self._vim.exec_lua(
+                'require("denshi.provider").setup(...)',
+                self._vim.api.create_namespace('denshi-provider'),
+                self._vim.channel_id)
 
     def echo(self, *msgs):
         msg = ' '.join([str(m) for m in msgs])
@@ -72,14 +119,24 @@ class Plugin:
     # buffer handler is completed before other events are handled.
     @neovim.function('DenshiBufEnter', sync=True)
     def event_buf_enter(self, args):
-        buf_num, view_start, view_stop = args
+        buf_num, view_start, view_stop, *visible = args
         self._select_handler(buf_num)
+        if visible:
+            self._rank_handlers(buf_num, visible[0])
         self._update_viewport(view_start, view_stop)
         self._cur_handler.update()
         self._mark_selected()
 
+    @neovim.function('DenshiRank')
+    def event_rank(self, args):
+        """Rank the handlers again after windows or tab pages changed."""
+        buf_num, visible = args
+        self._rank_handlers(buf_num, visible)
+
     @neovim.function('DenshiBufLeave', sync=True)
     def event_buf_leave(self, _):
+        if self._cur_handler is not None:
+            self._cur_handler.persist()
         self._cur_handler = None
 
     @neovim.function('DenshiBufWipeout', sync=True)
@@ -107,12 +164,45 @@ class Plugin:
             return
         # Note: TextChanged event doesn't trigger if text was changed in
         # unfocused buffer via e.g. nvim_buf_set_lines().
-        self._cur_handler.update()
+        self._cur_handler.update(changed=True)
+
+    @neovim.rpc_export('nvim_buf_lines_event', sync=False)
+    def event_buf_lines(self, *args):
+        buf, changedtick, first, last, linedata, _ = args
+        handler = self._handlers.get(buf.number)
+        if handler is not None:
+            handler.on_lines(changedtick, first, last, linedata)
+
+    @neovim.rpc_export('nvim_buf_changedtick_event', sync=False)
+    def event_buf_changedtick(self, *args):
+        pass
+
+    @neovim.rpc_export('nvim_buf_detach_event', sync=False)
+    def event_buf_detach(self, *args):
+        handler = self._handlers.get(args[0].number)
+        if handler is not None:
+            handler.on_detach()
+
+    @neovim.rpc_export('denshi_lines', sync=False)
+    def event_provider_lines(self, *args):
+        buf_num, first, last = args
+        handler = self._handlers.get(buf_num)
+        if handler is not None:
+            handler.serve_lines(first, last)
 
     @neovim.autocmd('VimLeave', sync=True)
     def event_vim_leave(self):
         for handler in self._handlers.values():
             handler.shutdown()
+        if self._worker is not None:
+            self._worker.close()
+        if self._pipeline is not None:
+            self._pipeline.close()
+        if self._session is not None:
+            self._session.close()
+        if self._cache is not None:
+            # Let the disk cache finish writing the buffers' entries
+            self._cache.flush(timeout=1)
 
     @neovim.command('Denshi', nargs='*', complete='customlist,DenshiComplete',
                     sync=True)
@@ -180,8 +270,15 @@ class Plugin:
         self._cur_handler.rename(self._vim.current.window.cursor, new_name)
 
     @subcommand(needs_handler=True, silent_fail=False)
-    def goto(self, *args, **kwargs):
-        self._cur_handler.goto(*args, **kwargs)
+    def goto(self, what, direction=None, count=1):
+        try:
+            num = int(count)
+        except ValueError:
+            num = 0
+        if num < 1:
+            self.echo_error('Invalid count: %s' % count)
+            return
+        self._cur_handler.goto(what, direction, num)
 
     @subcommand(needs_handler=True, silent_fail=False)
     def error(self):
@@ -191,27 +288,63 @@ class Plugin:
     def status(self):
         self.echo(
             'current handler: {handler}\n'
-            'handlers: {handlers}'
+            'handlers: {handlers}\n'
+            'parser session: {session}\n'
+            'parse cache: {cache}\n'
+            'update worker: {worker}\n'
+            'asyncio pipeline: {pipeline}\n'
+            'superseded parses: {superseded}'
             .format(
                 handler=self._cur_handler,
-                handlers=self._handlers
+                handlers=self._handlers,
+                session=self._session,
+                cache=self._cache,
+                worker=self._worker,
+                pipeline=self._pipeline,
+                superseded=sum(h.superseded_parses
+                               for h in self._handlers.values()),
             )
         )
 
     def _set_hl_groups(self):
+        commands = self._hl_group_commands()
+        if not commands:
+            return
+        _, error = self._vim.api.call_atomic(
+            [('nvim_command', (c,)) for c in commands])
+        if error is not None:
+            self.echo_error('Failed to define highlight group: %s' % (
+                error[2],))
+        self._hl_ids.refresh(self._hl_groups + [SELECTED])
+
+    def _hl_group_commands(self):
+        """Return the "hi def" commands for the highlight groups defined by
+        the parser config.
+
+        The output of the parser's `colors` subcommand is cached and only
+        regenerated when the config file changes.
+        """
+        config = self._options.config_location
+        try:
+            stamp = (config, os.stat(config).st_mtime_ns)
+        except OSError:
+            stamp = None
+        if stamp is not None and stamp == self._hl_commands_stamp:
+            return self._hl_commands
+
         args = [
             self._options.binary_location,
             "<placeholder>",
-            self._options.config_location,
+            config,
             "colors"
         ]
         
         proc = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
-        proc.wait()
-        output = proc.stdout.read()
+        output, _ = proc.communicate()
         
         
         commands = []
+        groups = []
         for line in output.split("\n"):
             split = line.split(" ")
             if len(split) < 2:
@@ -219,9 +352,12 @@ class Plugin:
             group = split[0]
             remainder = " ".join(split[1::])
             commands.append(f"hi def {group} {remainder}")
+            groups.append(group)
 
-        for c in commands:
-            self._vim.command(c)
+        self._hl_commands = commands
+        self._hl_groups = groups
+        self._hl_commands_stamp = stamp
+        return commands
 
     def _select_handler(self, buf_or_buf_num):
         """Select handler for `buf_or_buf_num`."""
@@ -236,7 +372,12 @@ class Plugin:
         except KeyError:
             if buf is None:
                 buf = self._vim.buffers[buf_num]
-            handler = BufferHandler(buf, self._vim, self._options)
+            handler = BufferHandler(buf, self._vim, self._options,
+                                    self._worker,
+                                    session=self._session,
+                                    cache=self._cache,
+                                    hl_ids=self._hl_ids,
+                                    pipeline=self._pipeline)
             self._handlers[buf_num] = handler
         self._cur_handler = handler
 
@@ -253,6 +394,18 @@ class Plugin:
         else:
             handler.shutdown()
 
+    def _rank_handlers(self, buf_num, visible):
+        """Rank the handlers by the visibility of their buffers, given the
+        current buffer `buf_num` and the buffers of all windows `visible`."""
+        visible = set(visible)
+        for num, handler in self._handlers.items():
+            if num == buf_num:
+                handler.set_rank(RANK_CURRENT)
+            elif num in visible:
+                handler.set_rank(RANK_VISIBLE)
+            else:
+                handler.set_rank(RANK_HIDDEN)
+
     def _update_viewport(self, start, stop):
         self._cur_handler.viewport(start, stop)
 
@@ -290,6 +443,31 @@ class Options:
         'tolerate_syntax_errors': True,
         'update_delay_factor': .0,
         'self_to_attribute': True,
+        'parser_session': True,
+        'parser_transport': 'stdin',
+        'incremental_sync': True,
+        # Number of lines around a change in which highlights are compared
+        # after a parse, or -1 for all lines. Highlights further away which
+        # are affected by a change (e.g. by changing a declaration) are only
+        # updated by the next forced update (":Denshi highlight").
+        'diff_window': -1,
+        # Draw highlights with a decoration provider which requests them only
+        # for the lines being drawn
+        'decoration_provider': False,
+        # Maximum number of parses running at the same time (over all
+        # buffers)
+        'max_parsers': 2,
+        # Seconds a hidden buffer must be unchanged before it's updated
+        'hidden_update_delay': 1.0,
+        # Run updates as asyncio tasks on the event loop of the host instead
+        # of on the update worker threads
+        'asyncio': False,
+        # Memory bound of the parse cache in MiB (0 disables it)
+        'parse_cache_size': 32,
+        # Directory of the persistent parse cache ('' disables it) and its
+        # size bound in MiB
+        'parse_cache_dir': '',
+        'parse_cache_dir_size': 256,
         'binary_location': "/home/kamei/projects/rust_projects/denshi-parser/target/release/denshi-parser",
         'config_location': "/home/kamei/.dotfiles/nvim/denshi-parser-config.toml"
     }
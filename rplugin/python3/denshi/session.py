@@ -0,0 +1,320 @@
+"""Client for a long-lived denshi-parser process.
+
+Instead of spawning the parser binary for every parse, a session keeps a
+single `denshi-parser <placeholder> <config> serve` process running and sends
+it framed requests over its stdin. All frames are UTF-8 encoded:
+
+    request:   b'parse <length>\\n' + <length> bytes of source code
+    response:  b'ok <length>\\n' + <length> bytes of node records
+               b'error <length>\\n' + <length> bytes of error message
+
+The node records use the same line format as the one-shot `parse`
+subcommand, so both paths share the decoder in denshi.parser.
+"""
+import os
+import select
+import subprocess
+from threading import Lock, Thread
+import time
+
+from .util import logger
+
+# Seconds to wait for the response to an abandoned request before the
+# process is killed instead
+DRAIN_TIMEOUT = 1.
+# Maximum number of bytes read from the process at once
+READ_SIZE = 1 << 20
+
+
+class SessionError(Exception):
+    """The parser reported an error for a request."""
+
+
+class SessionCrashed(SessionError):
+    """The parser process died while handling a request."""
+
+
+class SessionCancelled(Exception):
+    """The request was interrupted with `interrupt()`."""
+
+
+class SessionUnavailable(Exception):
+    """The session process can't be (re)started at the moment."""
+
+
+class SessionHealth:
+    """Failure bookkeeping shared by the session classes.
+
+    A request which makes the process die fails on its own (the process is
+    restarted for the next one). Only if more than `max_restarts` different
+    inputs crash the process in a row, the session marks itself as
+    unavailable, so callers fall back to spawning one process per parse. It
+    becomes available again after `retry_after` seconds.
+
+    If no process of the session has ever answered a request, the binary
+    most likely can't serve at all (e.g. it has no `serve` subcommand), so
+    the first failure makes the session unavailable right away.
+    """
+    def __init__(self, max_restarts=3, retry_after=60.):
+        self.max_restarts = max_restarts
+        self.retry_after = retry_after
+        # Hashes of the inputs which crashed the process since the last
+        # successful request
+        self._crashed_inputs = set()
+        # Time after which an unavailable session is tried again
+        self._disabled_until = None
+        # Whether any process of the session answered a request
+        self._answered = False
+
+    @property
+    def available(self):
+        if self._disabled_until is not None and \
+           time.monotonic() >= self._disabled_until:
+            self._disabled_until = None
+            self._crashed_inputs.clear()
+        return self._disabled_until is None
+
+    @available.setter
+    def available(self, available):
+        if available:
+            self._disabled_until = None
+            self._crashed_inputs.clear()
+        else:
+            self._disabled_until = time.monotonic() + self.retry_after
+
+    def _succeeded(self):
+        self._answered = True
+        self._crashed_inputs.clear()
+
+    def _crashed(self, data, error):
+        """Count a crash of the process on input `data` and return the
+        error to raise: SessionCrashed, or SessionUnavailable if the session
+        never worked."""
+        logger.debug('parser session failed: %s', error)
+        if not self._answered:
+            logger.error('Parser session exited before answering (%s), '
+                         'disabling it for %d s.', error, self.retry_after)
+            self.available = False
+            return SessionUnavailable()
+        self._crashed_inputs.add(hash(data))
+        if len(self._crashed_inputs) > self.max_restarts:
+            logger.error('Parser session crashed on %d inputs, disabling it '
+                         'for %d s.', len(self._crashed_inputs),
+                         self.retry_after)
+            self.available = False
+        return SessionCrashed('parser crashed: %s' % error)
+
+
+class ParserSession(SessionHealth):
+    """A persistent parser process shared by all buffer handlers.
+
+    Requests are serialized with a lock. If the process died while idle, it
+    is restarted transparently. A request can be interrupted, which abandons
+    it: its response is read and discarded in the background, so the
+    process (and its loaded config) can serve the next request. Only if the
+    response doesn't arrive within `drain_timeout` seconds, the process is
+    killed and restarted for the next request.
+    """
+    def __init__(self, binary_location, config_location, max_restarts=3,
+                 retry_after=60., drain_timeout=DRAIN_TIMEOUT):
+        super().__init__(max_restarts, retry_after)
+        self.drain_timeout = drain_timeout
+        self._args = [binary_location, '<placeholder>', config_location,
+                      'serve']
+        self._proc = None
+        self._lock = Lock()
+        # The cancel event of the request in progress, guarded by
+        # _interrupt_lock
+        self._current = None
+        self._interrupt_lock = Lock()
+        # Pipe to wake up the read of a response on interrupt()
+        self._wake = None
+        # Bytes read of the response in flight
+        self._response = bytearray()
+        # Time at which the request in flight was abandoned, or None
+        self._abandoned = None
+        # Number of times the process was (re)started
+        self.starts = 0
+        # Number of requests abandoned by interrupt()
+        self.abandoned = 0
+
+    def __repr__(self):
+        return '<ParserSession pid=%s starts=%d abandoned=%d available=%s>' % (
+            self._proc.pid if self._proc is not None else None,
+            self.starts,
+            self.abandoned,
+            self.available,
+        )
+
+    def parse(self, code, cancel=None):
+        """Return the node records for `code` as a string.
+
+        Raises SessionError if the parser rejected the code (SessionCrashed
+        if it died on it) and SessionUnavailable if there is no usable
+        process, or if no process ever answered. Raises SessionCancelled
+        if the threading.Event `cancel` is passed to `interrupt()`.
+        """
+        data = code.encode('utf-8')
+        with self._lock:
+            self._drain()
+            # A process which served requests before may have died since,
+            # so a failure on it is retried once on a new process
+            for retry in (True, False):
+                if cancel is not None and cancel.is_set():
+                    raise SessionCancelled()
+                if not self.available:
+                    raise SessionUnavailable()
+                fresh = self._proc is None or self._proc.poll() is not None
+                try:
+                    proc = self._ensure_started()
+                except OSError as e:
+                    logger.error('Failed to start parser session: %s', e)
+                    self.available = False
+                    raise SessionUnavailable()
+                with self._interrupt_lock:
+                    if cancel is not None and cancel.is_set():
+                        raise SessionCancelled()
+                    self._current = cancel
+                try:
+                    result = self._request(proc, data, cancel)
+                except SessionCancelled:
+                    self._abandon()
+                    raise
+                except (OSError, EOFError, ValueError) as e:
+                    self._kill()
+                    if retry and not fresh:
+                        continue
+                    raise self._crashed(data, e)
+                finally:
+                    with self._interrupt_lock:
+                        self._current = None
+                self._succeeded()
+                return result
+
+    def interrupt(self, cancel):
+        """Interrupt the request of `parse()` with the threading.Event
+        `cancel`, whether it's in progress or waiting."""
+        if cancel is None:
+            return
+        cancel.set()
+        with self._interrupt_lock:
+            if self._current is cancel and self._wake is not None:
+                os.write(self._wake[1], b'\0')
+
+    def close(self):
+        with self._lock:
+            self._kill()
+            if self._wake is not None:
+                for fd in self._wake:
+                    os.close(fd)
+                self._wake = None
+
+    def _ensure_started(self):
+        if self._wake is None:
+            self._wake = os.pipe()
+            for fd in self._wake:
+                os.set_blocking(fd, False)
+        if self._proc is None or self._proc.poll() is not None:
+            self._response.clear()
+            self._proc = subprocess.Popen(
+                self._args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self.starts += 1
+        return self._proc
+
+    def _request(self, proc, data, cancel):
+        proc.stdin.write(b'parse %d\n' % len(data))
+        proc.stdin.write(data)
+        proc.stdin.flush()
+        status, payload = self._read_response(proc, cancel)
+        payload = payload.decode('utf-8')
+        if status == b'error':
+            raise SessionError(payload)
+        return payload
+
+    def _read_response(self, proc, cancel=None, deadline=None):
+        """Read the response to the request in flight and return its status
+        and payload.
+
+        Raises SessionCancelled if `cancel` is set while waiting (the bytes
+        read so far are kept for the next call) and TimeoutError if the time
+        `deadline` of time.monotonic() passes.
+        """
+        fd = proc.stdout.fileno()
+        response = self._response
+        while True:
+            header_end = response.find(b'\n') + 1
+            if header_end:
+                header = bytes(response[:header_end])
+                status, length = header.split()
+                if status not in (b'ok', b'error'):
+                    raise ValueError('unexpected response header: %r' % header)
+                end = header_end + int(length)
+                if len(response) >= end:
+                    payload = bytes(response[header_end:end])
+                    del response[:end]
+                    return status, payload
+            if cancel is not None and cancel.is_set():
+                raise SessionCancelled()
+            timeout = None
+            if deadline is not None:
+                timeout = max(0., deadline - time.monotonic())
+            ready, _, _ = select.select([fd, self._wake[0]], [], [], timeout)
+            if not ready:
+                raise TimeoutError('no response from parser session')
+            if self._wake[0] in ready:
+                try:
+                    os.read(self._wake[0], 4096)
+                except BlockingIOError:
+                    pass
+            if fd in ready:
+                chunk = os.read(fd, READ_SIZE)
+                if not chunk:
+                    raise EOFError('parser session closed the connection')
+                response += chunk
+
+    def _abandon(self):
+        """Leave the response to the request in flight to be discarded by
+        a background thread (or the next request, if it's first)."""
+        self.abandoned += 1
+        self._abandoned = time.monotonic()
+        Thread(target=self._drain_locked, daemon=True).start()
+
+    def _drain_locked(self):
+        with self._lock:
+            self._drain()
+
+    def _drain(self):
+        """Discard the response to an abandoned request, or kill the process
+        if it doesn't arrive within `drain_timeout` of the abandonment."""
+        if self._abandoned is None:
+            return
+        deadline = self._abandoned + self.drain_timeout
+        self._abandoned = None
+        if self._proc is None:
+            return
+        try:
+            self._read_response(self._proc, deadline=deadline)
+        except (OSError, EOFError, ValueError) as e:
+            logger.debug('dropping parser session with abandoned request: '
+                         '%s', e)
+            self._kill()
+
+    def _kill(self):
+        proc = self._proc
+        self._proc = None
+        self._response.clear()
+        self._abandoned = None
+        if proc is None:
+            return
+        for stream in (proc.stdin, proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
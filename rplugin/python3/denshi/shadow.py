@@ -0,0 +1,65 @@
+from threading import Lock
+
+from .util import NO_CHANGE, lines_to_code, merge_hunks
+
+
+class ShadowBuffer:
+    """Copy of a buffer's lines kept in the host.
+
+    The copy is updated from the line events Neovim sends for buffers
+    attached via nvim_buf_attach(), so reading the buffer doesn't need an RPC
+    round-trip. It also tracks the hunk of lines changed since the last
+    snapshot.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.lines = None
+        self.changedtick = None
+        # changedtick of the content of the last snapshot
+        self.snapshot_tick = None
+        self._hunk = None
+
+    def __repr__(self):
+        return '<ShadowBuffer %s lines, tick %s>' % (
+            None if self.lines is None else len(self.lines), self.changedtick)
+
+    def reset(self):
+        """Forget the lines, e.g. because the buffer was detached."""
+        with self._lock:
+            self.lines = None
+            self.changedtick = None
+            self._hunk = None
+
+    def on_lines(self, changedtick, first, last, linedata):
+        """Apply a line event replacing lines `first:last` with `linedata`."""
+        with self._lock:
+            if self.lines is None:
+                if not (first == 0 and last == -1):
+                    # We missed the initial content
+                    return
+                self.lines = list(linedata)
+                self.changedtick = changedtick
+                # Unknown relation to previously parsed code
+                self._hunk = None
+                return
+            if last == -1:
+                last = len(self.lines)
+            self.lines[first:last] = linedata
+            self.changedtick = changedtick
+            if self._hunk is not None:
+                self._hunk = merge_hunks(
+                    self._hunk, (first, last, first + len(linedata)))
+
+    def snapshot(self):
+        """Return tuple (`code`, `hunk`) of the current content and the hunk
+        changed since the last snapshot, or None if the lines aren't known.
+
+        `hunk` is None if the changed lines are unknown.
+        """
+        with self._lock:
+            if self.lines is None:
+                return None
+            hunk = self._hunk
+            self._hunk = NO_CHANGE
+            self.snapshot_tick = self.changedtick
+            return lines_to_code(self.lines), hunk
@@ -0,0 +1,208 @@
+from bisect import bisect_left, bisect_right, insort
+
+
+class _Position:
+    """A position which compares to nodes like a node starting there."""
+    __slots__ = ['_tup']
+
+    def __init__(self, lineno, col):
+        self._tup = (lineno, col)
+
+
+def _index_add(index, key, node):
+    try:
+        insort(index[key], node)
+    except KeyError:
+        index[key] = [node]
+
+
+def _index_remove(index, key, node):
+    nodes = index[key]
+    i = bisect_left(nodes, node)
+    while nodes[i] is not node:
+        i += 1
+    del nodes[i]
+    if not nodes:
+        del index[key]
+
+
+class NodeStore:
+    """The current nodes of a buffer, indexed by line, name and highlight
+    group.
+
+    The nodes of each line are kept sorted by column, so looking up the node
+    at a position is a dict lookup plus a bisection. The nodes with the same
+    name, and the nodes with the same highlight group, are kept sorted by
+    position, so all occurrences of a name (in a range of lines) or the
+    neighbors of a position in a group can be looked up without touching
+    other nodes. Iterating over the store yields the nodes in buffer order.
+    """
+    def __init__(self, nodes=()):
+        # Mapping (line number -> (list of columns, list of nodes)), both
+        # sorted by column
+        self._lines = {}
+        # Mappings (name -> list of nodes sorted by position) and
+        # (highlight group -> list of nodes sorted by position)
+        self._names = {}
+        self._groups = {}
+        self._len = 0
+        self.add(nodes)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        lines = self._lines
+        for lineno in sorted(lines):
+            yield from lines[lineno][1]
+
+    def __repr__(self):
+        return '<NodeStore %d nodes in %d lines>' % (
+            self._len, len(self._lines))
+
+    def add(self, nodes):
+        lines = self._lines
+        for node in nodes:
+            try:
+                cols, line_nodes = lines[node.lineno]
+            except KeyError:
+                lines[node.lineno] = ([node.col], [node])
+            else:
+                index = bisect_right(cols, node.col)
+                cols.insert(index, node.col)
+                line_nodes.insert(index, node)
+            _index_add(self._names, node.name, node)
+            _index_add(self._groups, node.hl_group, node)
+            self._len += 1
+
+    def remove(self, nodes):
+        """Remove `nodes`. They must be the very node objects in the store."""
+        lines = self._lines
+        for node in nodes:
+            cols, line_nodes = lines[node.lineno]
+            index = bisect_left(cols, node.col)
+            while line_nodes[index] is not node:
+                index += 1
+            del cols[index]
+            del line_nodes[index]
+            if not cols:
+                del lines[node.lineno]
+            self._remove_indexed(node)
+            self._len -= 1
+
+    def _remove_indexed(self, node):
+        _index_remove(self._names, node.name, node)
+        _index_remove(self._groups, node.hl_group, node)
+
+    def pop_lines(self, start, stop):
+        """Remove and return all nodes in lines `start` to `stop` (exclusive).
+        """
+        lines = self._lines
+        if stop - start > len(lines):
+            linenos = [n for n in lines if start <= n < stop]
+        else:
+            linenos = range(start, stop)
+        nodes = []
+        for lineno in linenos:
+            entry = lines.pop(lineno, None)
+            if entry is not None:
+                nodes += entry[1]
+        for node in nodes:
+            self._remove_indexed(node)
+        self._len -= len(nodes)
+        return nodes
+
+    def shift(self, lineno, delta):
+        """Move all nodes in lines from `lineno` on by `delta` lines.
+
+        If `delta` is negative, the lines the nodes are moved into must be
+        empty.
+        """
+        if not delta:
+            return
+        lines = self._lines
+        moved = [(n, entry) for n, entry in lines.items() if n >= lineno]
+        for n, _ in moved:
+            del lines[n]
+        for n, entry in moved:
+            for node in entry[1]:
+                node.lineno += delta
+                node.update_tup()
+            lines[n + delta] = entry
+
+    def line(self, lineno):
+        """Return nodes in line `lineno`, sorted by column."""
+        try:
+            return self._lines[lineno][1]
+        except KeyError:
+            return []
+
+    def in_lines(self, start, stop):
+        """Return nodes in the lines `start` to `stop` (inclusive) in buffer
+        order."""
+        lines = self._lines
+        if stop - start >= len(lines):
+            linenos = sorted(n for n in lines if start <= n <= stop)
+        else:
+            linenos = range(start, stop + 1)
+        nodes = []
+        for lineno in linenos:
+            entry = lines.get(lineno)
+            if entry is not None:
+                nodes += entry[1]
+        return nodes
+
+    def by_name(self, name, start=None, stop=None):
+        """Return nodes named `name` sorted by position. If `start` and
+        `stop` are given, only return nodes in the lines `start` to `stop`
+        (inclusive)."""
+        nodes = self._names.get(name, [])
+        if start is None:
+            return nodes[:]
+        return nodes[bisect_left(nodes, _Position(start, -1)):
+                     bisect_left(nodes, _Position(stop + 1, -1))]
+
+    def by_group(self, group):
+        """Return nodes with highlight group `group` sorted by position."""
+        return self._groups.get(group, [])[:]
+
+    def group_end(self, group, last=False):
+        """Return the first node with highlight group `group` (the last one
+        if `last`), or None if there are none."""
+        nodes = self._groups.get(group)
+        if not nodes:
+            return None
+        return nodes[-1 if last else 0]
+
+    def group_neighbor(self, group, lineno, col, offset):
+        """Return the node with highlight group `group` which is `offset`
+        nodes after position (`lineno`, `col`), or before it if `offset` is
+        negative, wrapping around at the ends. Return None if there are no
+        nodes of that group."""
+        nodes = self._groups.get(group)
+        if not nodes:
+            return None
+        if offset > 0:
+            # Index of the first node after the position
+            index = bisect_left(nodes, _Position(lineno, col + 1))
+            return nodes[(index + offset - 1) % len(nodes)]
+        # Index of the first node at or after the position
+        index = bisect_left(nodes, _Position(lineno, col))
+        return nodes[(index + offset) % len(nodes)]
+
+    def at(self, lineno, col):
+        """Return the node covering column `col` in line `lineno`, or None."""
+        try:
+            cols, line_nodes = self._lines[lineno]
+        except KeyError:
+            return None
+        index = bisect_right(cols, col)
+        if not index:
+            return None
+        # Nodes don't overlap, so only the nodes starting at the closest
+        # column before `col` are candidates.
+        for i in range(bisect_left(cols, cols[index - 1]), index):
+            node = line_nodes[i]
+            if col < node.end:
+                return node
+        return None
@@ -0,0 +1,180 @@
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from operator import add, eq, lt
+
+from .node import KEY_COL, KEY_GROUP, KEY_LINENO, Node, pack_key
+
+
+class NodeTable:
+    """The nodes of a parse result, stored as columns.
+
+    Node `i` is described by the `i`th item of the int arrays `lineno`, `col`,
+    `end`, `group` and `name`, where `group` and `name` are indices into the
+    list of unique strings `strings`. Rows are sorted like nodes (by
+    position, then highlight group and name). Node objects are only created
+    when they're asked for, e.g. for the rows which have changed since the
+    last parse.
+    """
+    COLUMNS = ('lineno', 'col', 'end', 'group', 'name')
+
+    __slots__ = ['strings', *COLUMNS, '_keys']
+
+    def __init__(self, strings=(), lineno=None, col=None, end=None,
+                 group=None, name=None):
+        self.strings = list(strings)
+        self.lineno = array('I') if lineno is None else lineno
+        self.col = array('I') if col is None else col
+        self.end = array('I') if end is None else end
+        self.group = array('I') if group is None else group
+        self.name = array('I') if name is None else name
+        self._keys = None
+
+    @classmethod
+    def from_records(cls, records):
+        """Return table of records (`name`, `lineno`, `col`, `end`,
+        `hl_group`)."""
+        table = cls()
+        strings = {}
+        for name, lineno, col, end, group in records:
+            table.lineno.append(lineno)
+            table.col.append(col)
+            table.end.append(end)
+            table.group.append(strings.setdefault(group, len(strings)))
+            table.name.append(strings.setdefault(name, len(strings)))
+        table.strings = list(strings)
+        table.sort()
+        return table
+
+    @classmethod
+    def decode(cls, output):
+        """Return table of the node records in the parser output `output`.
+
+        Every line of the output is a record `hl_group lineno col end name`.
+        Fields after those are ignored. The fields go straight into the
+        columns, without building a record per line.
+        """
+        lineno = array('I')
+        col = array('I')
+        end = array('I')
+        group = array('I')
+        name = array('I')
+        strings = {}
+        string_index = strings.setdefault
+        for line in output.split('\n'):
+            fields = line.split(' ')
+            if len(fields) == 1:
+                continue
+            if len(fields) < 5:
+                raise ValueError('Malformed parser output: %r' % line)
+            group.append(string_index(fields[0], len(strings)))
+            lineno.append(int(fields[1]))
+            col.append(int(fields[2]))
+            end.append(int(fields[3]))
+            name.append(string_index(fields[4], len(strings)))
+        table = cls(strings, lineno, col, end, group, name)
+        table.sort()
+        return table
+
+    def __len__(self):
+        return len(self.lineno)
+
+    def __repr__(self):
+        return '<NodeTable %d rows, %d strings>' % (
+            len(self), len(self.strings))
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the table in bytes."""
+        return (len(self.COLUMNS) * self.lineno.itemsize * len(self) +
+                sum(50 + len(s) for s in self.strings))
+
+    def sort(self):
+        """Sort rows (if they aren't sorted already).
+
+        Rows are ordered by their positions packed into ints. Only if two
+        rows share a position, their groups and names are compared as well.
+        """
+        positions = zip(self.lineno, self.col)
+        following = islice(zip(self.lineno, self.col), 1, None)
+        if all(map(lt, positions, following)):
+            # Positions are strictly ascending, the usual case
+            return
+        positions = list(map(add, map(KEY_COL.__mul__, self.lineno),
+                             self.col))
+        order = sorted(range(len(self)), key=positions.__getitem__)
+        ordered = list(map(positions.__getitem__, order))
+        if not all(map(lt, ordered, islice(ordered, 1, None))):
+            order = sorted(range(len(self)), key=self.key)
+        if all(map(eq, order, range(len(self)))):
+            return
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            setattr(self, column, array('I', map(values.__getitem__, order)))
+        self._keys = None
+
+    def key(self, row):
+        """Return tuple of `row` which compares like the tuple of a node."""
+        strings = self.strings
+        return (self.lineno[row], self.col[row], strings[self.group[row]],
+                strings[self.name[row]])
+
+    def keys(self, ids, rows=None):
+        """Return the packed keys of rows, equal to the keys of their nodes
+        with the StringIds `ids`: a list of the keys of all rows, or a dict
+        of the keys of `rows` by row.
+
+        The keys of all rows are cached for the last `ids` they were asked
+        for.
+        """
+        cached = self._keys
+        if cached is not None and cached[0] is ids:
+            return cached[1]
+        if rows is not None:
+            strings = self.strings
+            get = ids.get
+            return {row: pack_key(self.lineno[row], self.col[row],
+                                  get(strings[self.group[row]]),
+                                  get(strings[self.name[row]]))
+                    for row in rows}
+        string_ids = [ids.get(s) for s in self.strings]
+        keys = list(map(
+            add,
+            map(add, map(KEY_LINENO.__mul__, self.lineno),
+                map(KEY_COL.__mul__, self.col)),
+            map(add, map(KEY_GROUP.__mul__, map(string_ids.__getitem__,
+                                                self.group)),
+                map(string_ids.__getitem__, self.name)),
+        ))
+        self._keys = (ids, keys)
+        return keys
+
+    def records(self):
+        """Yield records (`name`, `lineno`, `col`, `end`, `hl_group`)."""
+        strings = self.strings
+        for row in range(len(self)):
+            yield (strings[self.name[row]], self.lineno[row], self.col[row],
+                   self.end[row], strings[self.group[row]])
+
+    def node(self, row):
+        """Return new node of `row`."""
+        strings = self.strings
+        return Node(strings[self.name[row]], self.lineno[row], self.col[row],
+                    self.end[row], strings[self.group[row]])
+
+    def nodes(self, rows=None, keys=None):
+        """Return list of new nodes of `rows` (by default all rows). If the
+        `keys` of the rows (see keys()) are given, the nodes get theirs."""
+        if rows is None:
+            rows = range(len(self))
+        nodes = [self.node(row) for row in rows]
+        if keys is not None:
+            for node, row in zip(nodes, rows):
+                node.key = keys[row]
+        return nodes
+
+    def line_rows(self, start, stop):
+        """Return range of rows in the lines `start` to `stop` (inclusive).
+        """
+        lineno = self.lineno
+        return range(bisect_left(lineno, start), bisect_left(lineno, stop + 1))
@@ -0,0 +1,89 @@
+"""Ways of handing the buffer text to a one-shot parser process.
+
+The parser binary takes the path of the file to parse on its command line. A
+transport decides what that path points to, what (if anything) is written to
+the process' stdin and which file descriptors the process inherits.
+"""
+from contextlib import contextmanager
+import os
+import tempfile
+
+from .util import logger
+
+
+class TempFileTransport:
+    """Write the code to a named temporary file."""
+    name = 'tempfile'
+
+    @staticmethod
+    @contextmanager
+    def handoff(code):
+        """Yield a tuple (`path`, `stdin`, `pass_fds`) for a parser run on
+        `code`."""
+        with tempfile.NamedTemporaryFile(mode='w+t') as tmp_file:
+            tmp_file.write(code)
+            tmp_file.flush()
+            yield tmp_file.name, None, ()
+
+    def close(self):
+        pass
+
+
+class StdinTransport:
+    """Stream the code through the process' stdin.
+
+    The parser reads it from /dev/stdin, so no buffer text touches the file
+    system.
+    """
+    name = 'stdin'
+
+    @staticmethod
+    @contextmanager
+    def handoff(code):
+        yield '/dev/stdin', code, ()
+
+    def close(self):
+        pass
+
+
+class MemfdTransport:
+    """Write the code into an anonymous in-memory file.
+
+    The process inherits the file descriptor and gets /proc/self/fd/N as the
+    path, so the parser's command line stays the same while no real file is
+    created. The memfd is created once and rewritten for every parse.
+    """
+    name = 'memfd'
+
+    def __init__(self):
+        fd = os.memfd_create('denshi-buffer', os.MFD_CLOEXEC)
+        self._file = os.fdopen(fd, 'w+b')
+
+    @contextmanager
+    def handoff(self, code):
+        file = self._file
+        file.seek(0)
+        file.truncate()
+        file.write(code.encode('utf-8'))
+        file.flush()
+        fd = file.fileno()
+        yield '/proc/self/fd/%d' % fd, None, (fd,)
+
+    def close(self):
+        self._file.close()
+
+
+_transports = {t.name: t for t in
+               (TempFileTransport, StdinTransport, MemfdTransport)}
+
+
+def make_transport(name):
+    """Return a new transport for the transport name `name`."""
+    try:
+        cls = _transports[name]
+    except KeyError:
+        raise ValueError('Unknown parser transport: %s' % name)
+    if cls is MemfdTransport and not hasattr(os, 'memfd_create'):
+        logger.error('memfd_create() is not available, using stdin instead.')
+        cls = StdinTransport
+    return cls()
@@ -11,6 +11,27 @@ def code_to_lines(code):
     return code.split('\n')
 
 
+# A hunk (`start`, `old_stop`, `new_stop`) describes that the lines
+# `start:old_stop` of a buffer were replaced by the lines `start:new_stop`.
+NO_CHANGE = (0, 0, 0)
+
+
+def merge_hunks(first, second):
+    """Return the hunk equivalent to applying hunk `first`, then `second`."""
+    if first[0] == first[1] == first[2]:
+        return second
+    if second[0] == second[1] == second[2]:
+        return first
+    start, old_stop, new_stop = first
+    start2, old_stop2, new_stop2 = second
+    # End of the region touched by either hunk, in the line numbers between
+    # both changes
+    stop = max(new_stop, old_stop2)
+    return (min(start, start2),
+            old_stop + stop - new_stop,
+            new_stop2 + stop - old_stop2)
+
+
 def debug_time(label_or_callable=None, detail=None):
     def inner(func):
         @functools.wraps(func)
@@ -0,0 +1,323 @@
+"""A small pool of background threads running the jobs of all buffer
+handlers."""
+from collections import deque
+from functools import partial
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Event, Thread
+import time
+
+from .util import logger
+
+
+# Ranks of the buffer a job is for (lower runs first): the buffer of the
+# current window, of other visible windows and hidden buffers
+RANK_CURRENT = 0
+RANK_VISIBLE = 1
+RANK_HIDDEN = 2
+
+# Job priorities within a rank (lower runs first). The main thread waits
+# for sync jobs (see UpdateWorker.run()).
+PRIORITY_SYNC = -1
+PRIORITY_VIEWPORT = 0
+PRIORITY_UPDATE = 1
+PRIORITY_ERROR_SIGN = 2
+
+
+class _Job:
+    __slots__ = ['func', 'rank', 'priority', 'seq', 'due', 'group', 'idle']
+
+    def __init__(self, func, rank, priority, seq, due, group, idle):
+        self.func = func
+        self.rank = rank
+        self.priority = priority
+        self.seq = seq
+        # Time the job becomes runnable
+        self.due = due
+        self.group = group
+        self.idle = idle
+
+
+class UpdateWorker:
+    """Runs jobs in `threads` background threads, in order of rank and
+    priority.
+
+    Every job has a key (e.g. the kind of job and a buffer number). Queuing
+    a job while a job with the same key is still waiting replaces the
+    waiting job, so bursts of updates for a buffer coalesce into one run.
+    Jobs can be delayed to run no earlier than a number of seconds later.
+
+    Jobs of the same group (e.g. of one buffer) never run at the same time,
+    and idle jobs only run while no other job is running. As parses only
+    run in jobs, `threads` limits the number of parser processes.
+
+    Jobs run functions on the main thread with `call_main()`, which queues
+    them to run in order through `async_call` (e.g. `vim.async_call`). The
+    main thread can also wait for a job with `run()`, and runs the queued
+    calls meanwhile. Without `async_call`, they run right away.
+    """
+    def __init__(self, threads=1, async_call=None):
+        self._cond = Condition()
+        self._async_call = async_call
+        # Functions queued by call_main()
+        self._main_calls = deque()
+        # Mapping (key -> waiting job)
+        self._jobs = {}
+        # Heaps of (`rank`, `priority`, `seq`, `key`) of runnable jobs and of
+        # (`due`, `seq`, `key`) of delayed jobs. Entries whose `seq` doesn't
+        # match the job of their key anymore are stale and skipped.
+        self._ready = []
+        self._delayed = []
+        self._seq = count()
+        self._closed = False
+        # Groups of the running jobs
+        self._active = set()
+        # Metrics
+        self.runs = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+        self._threads = [
+            Thread(target=self._run, name='denshi-worker-%d' % i, daemon=True)
+            for i in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __repr__(self):
+        return ('<UpdateWorker %d threads, depth %d (max %d), %d runs, '
+                '%d coalesced, wait %.1f ms mean / %.1f ms max>' % (
+                    len(self._threads), self.depth, self.max_depth,
+                    self.runs, self.coalesced, self.mean_wait * 1e3,
+                    self.max_wait * 1e3))
+
+    @property
+    def depth(self):
+        """Number of waiting jobs."""
+        return len(self._jobs)
+
+    @property
+    def busy(self):
+        """Whether a job is running or runnable (delayed jobs don't count)."""
+        now = time.monotonic()
+        with self._cond:
+            return bool(self._active) or any(
+                job.due <= now for job in self._jobs.values())
+
+    @property
+    def mean_wait(self):
+        """Mean time in seconds between a job becoming runnable and running
+        it."""
+        return self.total_wait / self.runs if self.runs else 0.
+
+    def submit(self, key, func, priority=PRIORITY_UPDATE, delay=0,
+               rank=RANK_CURRENT, group=None, idle=False):
+        """Queue `func()` to run as job `key` with `rank` and `priority`,
+        after `delay` seconds. The job belongs to `group` (by default
+        `key`). If `idle`, it only runs while no other job is running.
+
+        If job `key` is waiting already, it's replaced. It keeps the higher
+        rank and priority of both, and its place in the queue if it's
+        runnable and `delay` is 0. Otherwise, it's delayed again.
+        """
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                return
+            job = self._jobs.get(key)
+            if job is None:
+                job = _Job(func, rank, priority, next(self._seq), now + delay,
+                           key if group is None else group, idle)
+                self._jobs[key] = job
+                self.max_depth = max(self.max_depth, len(self._jobs))
+            else:
+                self.coalesced += 1
+                job.func = func
+                if job.idle and not idle:
+                    # May be runnable now
+                    job.idle = False
+                    self._cond.notify_all()
+                higher = (rank, priority) < (job.rank, job.priority)
+                if not delay and job.due <= now and not higher:
+                    return
+                job.rank, job.priority = min((job.rank, job.priority),
+                                             (rank, priority))
+                job.seq = next(self._seq)
+                job.due = now + delay
+            self._push(key, job)
+
+    def run(self, key, func, group=None):
+        """Run `func()` as job `key` of `group` (see submit()) before all
+        other waiting jobs, and return its result (or raise its exception)
+        once it ran.
+
+        Must be called on the main thread, which runs the calls of
+        call_main() of all jobs while it waits.
+        """
+        outcome = []
+
+        def job():
+            try:
+                outcome.append((func(), None))
+            except Exception as e: # pylint: disable=broad-except
+                outcome.append((None, e))
+            finally:
+                with self._cond:
+                    self._cond.notify_all()
+        if self._closed:
+            return None
+        self.submit(key, job, PRIORITY_SYNC, group=group)
+        while True:
+            with self._cond:
+                while not outcome and not self._main_calls:
+                    self._cond.wait()
+                done = bool(outcome)
+            # Calls of the job itself run before returning, too
+            self.run_main_calls()
+            if done:
+                break
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+
+    def call_main(self, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` on the main thread after the calls
+        queued before, and return right away."""
+        if self._async_call is None:
+            func(*args, **kwargs)
+            return
+        with self._cond:
+            self._main_calls.append(partial(func, *args, **kwargs))
+            self._cond.notify_all()
+        self._async_call(self.run_main_calls)
+
+    def wait_main(self, func):
+        """Return `func()`, run on the main thread like with call_main()."""
+        outcome = []
+        event = Event()
+
+        def call():
+            try:
+                outcome.append((func(), None))
+            except Exception as e: # pylint: disable=broad-except
+                outcome.append((None, e))
+            finally:
+                event.set()
+        self.call_main(call)
+        event.wait()
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+
+    def run_main_calls(self):
+        """Run the calls queued by call_main(). Must be called on the main
+        thread."""
+        while True:
+            with self._cond:
+                if not self._main_calls:
+                    return
+                func = self._main_calls.popleft()
+            try:
+                func()
+            except Exception: # pylint: disable=broad-except
+                import traceback # pylint: disable=import-outside-toplevel
+                logger.error('Exception: %s', traceback.format_exc())
+
+    def reschedule(self, key, rank, delay=None, idle=False):
+        """Change the rank of waiting job `key` (if any) to `rank`, and run
+        it after `delay` seconds (by default when it's due anyway). If
+        `idle`, it only runs while no other job is running."""
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job.rank = rank
+            job.idle = idle
+            job.seq = next(self._seq)
+            if delay is not None:
+                job.due = time.monotonic() + delay
+            self._push(key, job)
+
+    def _push(self, key, job):
+        if job.due > time.monotonic():
+            heappush(self._delayed, (job.due, job.seq, key))
+        else:
+            heappush(self._ready, (job.rank, job.priority, job.seq, key))
+        self._cond.notify_all()
+
+    def cancel(self, key):
+        """Drop waiting job `key` (if any)."""
+        with self._cond:
+            self._jobs.pop(key, None)
+
+    def close(self):
+        """Drop all waiting jobs and stop the thread after the current job."""
+        with self._cond:
+            self._closed = True
+            self._jobs.clear()
+            self._cond.notify_all()
+
+    def _next_job(self):
+        """Return the next job to run, or None if the worker was closed."""
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, key = heappop(self._delayed)
+                    job = self._jobs.get(key)
+                    if job is not None and job.seq == seq:
+                        heappush(self._ready,
+                                 (job.rank, job.priority, seq, key))
+                job = self._pop_ready()
+                if job is not None:
+                    wait = max(0., now - job.due)
+                    self.runs += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    self._active.add(job.group)
+                    return job
+                timeout = None
+                if self._delayed:
+                    timeout = self._delayed[0][0] - now
+                self._cond.wait(timeout)
+        return None
+
+    def _pop_ready(self):
+        """Remove and return the first runnable job which may run now, or
+        return None if there is none."""
+        skipped = []
+        try:
+            while self._ready:
+                entry = heappop(self._ready)
+                key = entry[-1]
+                job = self._jobs.get(key)
+                if job is None or job.seq != entry[-2]:
+                    continue
+                if job.group in self._active or (job.idle and self._active):
+                    # Runs once the blocking job is done
+                    skipped.append(entry)
+                    continue
+                del self._jobs[key]
+                return job
+            return None
+        finally:
+            for entry in skipped:
+                heappush(self._ready, entry)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                job.func()
+            except Exception: # pylint: disable=broad-except
+                import traceback # pylint: disable=import-outside-toplevel
+                logger.error('Exception: %s', traceback.format_exc())
+            finally:
+                with self._cond:
+                    self._active.discard(job.group)
+                    self._cond.notify_all()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Benchmark decoding parser output into nodes.
+
+Usage: bench_decode.py [runs] [records...]
+
+Compares the per-line loop which decoded the output into record tuples
+(before creating a node per record) against the NodeTable decoder, by
+default on 10k, 100k and 1M records.
+"""
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'rplugin/python3'))
+
+from denshi.table import NodeTable # noqa pylint: disable=wrong-import-position
+
+
+GROUPS = ['denshiKeyword', 'denshiIdentifier', 'denshiModuleName',
+          'denshiPortName']
+
+
+def make_output(num_records):
+    """Return parser output with `num_records` records, four per line."""
+    return ''.join(
+        '%s %d %d %d sig_%d\n' % (GROUPS[i % 4], i // 4 + 1, i % 4 * 10,
+                                  i % 4 * 10 + 8, i % 5000)
+        for i in range(num_records))
+
+
+def decode_loop(output):
+    """The decoder loop used before NodeTable, without the node creation
+    which followed it."""
+    records = []
+    for line in output.split("\n"):
+        s = line.split(" ")
+        if len(s) == 1:
+            continue
+        records.append((s[4], int(s[1]), int(s[2]), int(s[3]), s[0]))
+    return records
+
+
+def bench(func, output, runs):
+    times = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        func(output)
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 3
+    sizes = [int(a) for a in argv[2:]] or [10000, 100000, 1000000]
+    print('min of %d runs in ms' % runs)
+    print('%10s %12s %12s %8s' % ('records', 'tuples', 'table', 'speedup'))
+    for size in sizes:
+        output = make_output(size)
+        loop = bench(decode_loop, output, runs)
+        table = bench(NodeTable.decode, output, runs)
+        print('%10d %12.2f %12.2f %7.1fx' % (
+            size, loop * 1e3, table * 1e3, loop / table))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Benchmark one process per parse against a persistent parser session.
+
+Usage: bench_parser.py [binary] [config] [lines] [runs]
+
+Without arguments, the Python stand-in parser (fake_parser.py) is used.
+"""
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'rplugin/python3'))
+
+from denshi.parser import Parser # noqa pylint: disable=wrong-import-position
+from denshi.session import ParserSession # noqa pylint: disable=wrong-import-position
+
+
+def make_code(num_lines):
+    return '\n'.join(
+        'assign sig_%d = a_%d & b_%d;' % (i, i, i) for i in range(num_lines))
+
+
+def bench(parser, code, runs):
+    times = []
+    for i in range(runs):
+        # Change one line every time so each run does a real parse
+        changed = code + ' x%d' % i
+        t = time.perf_counter()
+        parser.parse(changed)
+        times.append(time.perf_counter() - t)
+    return min(times), sum(times) / len(times)
+
+
+def main(argv):
+    binary = argv[1] if len(argv) > 1 else \
+        str(Path(__file__).parent / 'fake_parser.py')
+    config = argv[2] if len(argv) > 2 else 'config.toml'
+    num_lines = int(argv[3]) if len(argv) > 3 else 20000
+    runs = int(argv[4]) if len(argv) > 4 else 20
+    code = make_code(num_lines)
+
+    print('%d lines, %d runs (min / mean in ms)' % (num_lines, runs))
+    best, mean = bench(Parser(config, binary), code, runs)
+    print('one-shot: %8.2f / %8.2f' % (best * 1e3, mean * 1e3))
+    session = ParserSession(binary, config)
+    try:
+        best, mean = bench(Parser(config, binary, session=session), code, runs)
+    finally:
+        session.close()
+    print('session:  %8.2f / %8.2f' % (best * 1e3, mean * 1e3))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
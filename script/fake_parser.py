@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""A stand-in for the denshi-parser binary.
+
+Speaks the same command line interface and session protocol as the real
+parser so the plugin can be tested and benchmarked without the Rust build:
+
+    fake_parser.py <file> <config> parse    print node records for <file>
+    fake_parser.py <file> <config> colors   print highlight group definitions
+    fake_parser.py <file> <config> serve    serve framed parse requests
+
+Every identifier becomes a node; identifiers in `KEYWORDS` get their own
+highlight group. A request whose code contains `CRASH_MARKER` makes the
+server exit without answering, which is useful to test restarts. Setting
+DENSHI_FAKE_PARSER_DELAY to a number of seconds slows down every parse, and
+setting DENSHI_FAKE_PARSER_NO_SERVE makes it reject `serve` like parser
+builds without a session mode.
+"""
+import os
+import re
+import sys
+import time
+
+IDENTIFIER = re.compile(rb'[A-Za-z_][A-Za-z0-9_$]*')
+KEYWORDS = {
+    b'module', b'endmodule', b'input', b'output', b'inout', b'wire', b'reg',
+    b'logic', b'always', b'always_ff', b'always_comb', b'assign', b'begin',
+    b'end', b'if', b'else', b'case', b'endcase', b'parameter', b'localparam',
+}
+COLORS = {
+    'denshiKeyword': 'ctermfg=214 guifg=#ffaf00',
+    'denshiIdentifier': 'ctermfg=109 guifg=#87afaf',
+}
+CRASH_MARKER = b'__denshi_fake_parser_crash__'
+
+
+def records(code):
+    """Return node records (as bytes) for `code` (bytes)."""
+    time.sleep(float(os.environ.get('DENSHI_FAKE_PARSER_DELAY', 0)))
+    out = []
+    for lineno, line in enumerate(code.split(b'\n'), 1):
+        for match in IDENTIFIER.finditer(line):
+            name = match.group()
+            group = b'denshiKeyword' if name in KEYWORDS else \
+                b'denshiIdentifier'
+            out.append(b'%s %d %d %d %s\n' % (
+                group, lineno, match.start(), match.end(), name))
+    return b''.join(out)
+
+
+def serve(stdin, stdout):
+    while True:
+        header = stdin.readline()
+        if not header:
+            return
+        command, length = header.split()
+        code = stdin.read(int(length))
+        if CRASH_MARKER in code:
+            sys.exit(1)
+        if command != b'parse':
+            message = b'unknown command: ' + command
+            stdout.write(b'error %d\n%s' % (len(message), message))
+        else:
+            payload = records(code)
+            stdout.write(b'ok %d\n%s' % (len(payload), payload))
+        stdout.flush()
+
+
+def main(argv):
+    path, _, command = argv[1:4]
+    if command == 'parse':
+        with open(path, 'rb') as f:
+            sys.stdout.buffer.write(records(f.read()))
+    elif command == 'colors':
+        for group, definition in COLORS.items():
+            print(group, definition)
+    elif command == 'serve' and \
+            not os.environ.get('DENSHI_FAKE_PARSER_NO_SERVE'):
+        serve(sys.stdin.buffer, sys.stdout.buffer)
+    else:
+        sys.exit('unknown command: %s' % command)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,9 +1,14 @@
 import ast
+from pathlib import Path
 from textwrap import dedent
 
 from denshi.parser import Parser
 
 
+# Python stand-in for the denshi-parser binary
+FAKE_PARSER = str(Path(__file__).parent.parent / 'script/fake_parser.py')
+
+
 def make_tree(names):
     root = {}
     for node in names:
@@ -0,0 +1,141 @@
+import os
+import zlib
+
+import pytest
+
+from denshi.cache import DiskCache, ParseCache, cache_key, parser_identity
+from denshi.parser import Parser
+from denshi.table import NodeTable
+
+from .conftest import FAKE_PARSER
+
+
+def test_cache_key(tmp_path):
+    config = tmp_path / 'config.toml'
+    config.write_text('a = 1')
+    identity = parser_identity(FAKE_PARSER, str(config))
+    assert cache_key('foo', identity) == cache_key('foo', identity)
+    assert cache_key('foo', identity) != cache_key('bar', identity)
+    config.write_text('a = 2')
+    other = parser_identity(FAKE_PARSER, str(config))
+    assert cache_key('foo', identity) != cache_key('foo', other)
+
+
+def make_table(name):
+    return NodeTable.from_records([(name, 1, 0, 1, 'g')])
+
+
+def test_lru_eviction():
+    entry_size = make_table('a').nbytes
+    cache = ParseCache(3 * entry_size)
+    for key in 'abc':
+        cache.put(key, make_table(key))
+    assert cache.get('a') is not None
+    cache.put('d', make_table('d'))
+    assert cache.get('b') is None
+    assert [cache.get(k).node(0).name for k in 'acd'] == ['a', 'c', 'd']
+    assert cache.size == 3 * entry_size
+    # Entries larger than the whole cache aren't stored
+    cache.put('e', NodeTable.from_records(
+        [('e', i, 0, 1, 'g') for i in range(100)]))
+    assert cache.get('e') is None
+    assert len(cache) == 3
+
+
+def test_parser_cache_hit(monkeypatch):
+    parser = Parser('config.toml', FAKE_PARSER, cache=ParseCache(1 << 20))
+    parser.parse('foo')
+    add, rem = parser.parse('bar')
+    def fail(code):
+        pytest.fail('parser binary was run')
+    monkeypatch.setattr(parser, '_run', fail)
+    add, rem = parser.parse('foo')
+    assert [n.name for n in add] == ['foo']
+    assert [n.name for n in rem] == ['bar']
+    assert parser._cache.hits == 1
+
+
+RECORDS = [
+    ('foo', 1, 0, 3, 'denshiIdentifier'),
+    ('module', 2, 4, 10, 'denshiKeyword'),
+    ('bär', 100000, 7, 11, 'denshiIdentifier'),
+]
+TABLE = NodeTable.from_records(RECORDS)
+
+
+def records(table):
+    return None if table is None else list(table.records())
+
+
+def test_disk_cache_format():
+    data = DiskCache.encode(TABLE)
+    assert records(DiskCache.decode(data)) == RECORDS
+    assert records(DiskCache.decode(DiskCache.encode(NodeTable()))) == []
+    with pytest.raises(ValueError):
+        DiskCache.decode(zlib.compress(b'XXXX' + data[4:]))
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), 1 << 20)
+    assert cache.get(b'key') is None
+    cache.put(b'key', TABLE)
+    assert records(cache.get(b'key')) == RECORDS
+    # A new cache instance (e.g. in another session) sees the entry
+    assert records(DiskCache(str(tmp_path / 'cache'), 1 << 20).get(
+        b'key')) == RECORDS
+    # Corrupt entries are discarded
+    (tmp_path / 'cache' / b'key'.hex()).write_bytes(b'garbage')
+    assert cache.get(b'key') is None
+    assert not (tmp_path / 'cache' / b'key'.hex()).exists()
+
+
+def test_disk_cache_prune(tmp_path):
+    entry_size = len(DiskCache.encode(TABLE))
+    cache = DiskCache(str(tmp_path), 4 * entry_size)
+    for i in range(10):
+        cache.put(b'%d' % i, TABLE)
+        os.utime(str(tmp_path / (b'%d' % i).hex()), (i, i))
+    assert cache._total_size() <= 4 * entry_size
+    assert records(cache.get(b'9')) == RECORDS
+    assert cache.get(b'0') is None
+
+
+def test_memory_cache_falls_back_to_disk(tmp_path):
+    disk = DiskCache(str(tmp_path), 1 << 20)
+    ParseCache(1 << 20, disk=disk).put(b'key', TABLE, persist=True)
+    disk.flush()
+    cache = ParseCache(1 << 20, disk=disk)
+    assert records(cache.get(b'key')) == RECORDS
+    assert disk.hits == 1
+    assert records(cache.get(b'key')) == RECORDS
+    assert disk.hits == 1
+
+
+def test_persist_later(tmp_path):
+    disk = DiskCache(str(tmp_path), 1 << 20)
+    cache = ParseCache(1 << 20, disk=disk)
+    cache.put(b'a', TABLE)
+    cache.put(b'b', TABLE)
+    # Not written without persisting
+    cache.flush()
+    assert os.listdir(str(tmp_path)) == []
+    cache.persist(b'b')
+    cache.persist(b'missing')
+    cache.flush()
+    assert os.listdir(str(tmp_path)) == [b'b'.hex()]
+    assert records(disk.get(b'b')) == RECORDS
+
+
+def test_parser_persists_first_parse(tmp_path):
+    disk = DiskCache(str(tmp_path), 1 << 20)
+    cache = ParseCache(1 << 20, disk=disk)
+    parser = Parser('config.toml', FAKE_PARSER, cache=cache)
+    parser.parse('foo')
+    cache.flush()
+    assert len(os.listdir(str(tmp_path))) == 1
+    parser.parse('foo bar')
+    cache.flush()
+    assert len(os.listdir(str(tmp_path))) == 1
+    parser.persist()
+    cache.flush()
+    assert len(os.listdir(str(tmp_path))) == 2
@@ -0,0 +1,265 @@
+import asyncio
+from types import SimpleNamespace
+
+import msgpack
+
+from denshi.handler import (BUFFER_PACKED_SIZE, BufferHandler, clear_ranges,
+                            nodes_to_hl, split_batches)
+from denshi.node import Node
+from denshi.parser import Parser
+from denshi.pipeline import ParseSlots
+from denshi.plugin import Options
+from denshi.worker import RANK_HIDDEN, RANK_VISIBLE
+
+from .conftest import FAKE_PARSER
+
+
+class FakeApi:
+    """Records the requests of a handler."""
+    def __init__(self):
+        self.calls = []
+        self._namespaces = {}
+
+    def create_namespace(self, name):
+        return self._namespaces.setdefault(name, len(self._namespaces) + 1)
+
+    def call_atomic(self, calls, async_=False):
+        self.calls += calls
+
+    def attach(self, *args):
+        pass
+
+
+class FakeVim:
+    def __init__(self, **options):
+        self.api = FakeApi()
+        self.vars = {'denshi#' + k: v for k, v in dict(
+            binary_location=FAKE_PARSER, config_location='config.toml',
+            error_sign=False, **options).items()}
+        self.current = SimpleNamespace(window=SimpleNamespace(cursor=(1, 0)))
+        self.lua = []
+
+    def async_call(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def exec_lua(self, code, *args, async_=False):
+        self.lua.append((code, args))
+
+
+class FakeWorker:
+    """Runs jobs right away, and records their keys and delays."""
+    def __init__(self):
+        self.submitted = []
+        self.rescheduled = []
+
+    def submit(self, key, func, *args, delay=0, **kwargs):
+        self.submitted.append((key, delay))
+        func()
+
+    def run(self, key, func, group=None):
+        self.submitted.append((key, 'sync'))
+        return func()
+
+    def call_main(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def wait_main(self, func):
+        return func()
+
+    def reschedule(self, key, rank, delay=None, idle=False):
+        self.rescheduled.append((key, rank, delay))
+
+    def cancel(self, key):
+        pass
+
+
+def make_handler(pipeline=None, **options):
+    vim = FakeVim(**options)
+    buf = SimpleNamespace(number=1, api=vim.api)
+    handler = BufferHandler(buf, vim, Options(vim), FakeWorker(),
+                            pipeline=pipeline)
+    return handler, vim
+
+
+def test_clear_ranges():
+    nodes = [Node('foo', lineno, 0, 3, 'g') for lineno in (2, 5, 6, 9)]
+    assert clear_ranges((3, 5), []) == []
+    assert clear_ranges(None, nodes) == [(0, -1)]
+    # Nodes in the changed lines don't add ranges, adjacent lines are merged
+    assert clear_ranges((3, 5), nodes) == [(1, 2), (3, 6), (8, 9)]
+    # Deleted lines clear the line after them
+    assert clear_ranges((7, 7), nodes[:1]) == [(1, 2), (7, 8)]
+
+
+def test_parser_changed():
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('foo\nbar\nbaz', force=True)
+    assert parser.changed is None
+    parser.parse('foo\nqux\nquux\nbaz', hunk=(1, 2, 3))
+    assert parser.changed == (1, 3)
+    parser.parse('foo\nbaz', hunk=(1, 3, 1))
+    assert parser.changed == (1, 1)
+    # Without a hunk, a change of the line count replaces all nodes
+    parser.parse('foo\nbar\nbaz')
+    assert parser.changed is None
+
+
+def test_nodes_to_hl():
+    node = Node('foo', 3, 4, 7, 'denshiKeyword')
+    (line, col, opts), = nodes_to_hl([node])
+    assert (line, col) == (2, 4)
+    assert opts['end_col'] == 7
+    assert opts['hl_group'] == 'denshiKeyword'
+    (_, _, opts), = nodes_to_hl([node], marked=True)
+    assert opts['hl_group'] == 'denshiSelected'
+    ids = {'denshiKeyword': 7, 'denshiSelected': 8}
+    (_, _, opts), = nodes_to_hl([node], hl_ids=ids)
+    assert opts['hl_group'] == 7
+    (_, _, opts), = nodes_to_hl([node], marked=True, hl_ids=ids)
+    assert opts['hl_group'] == 8
+
+
+def test_split_batches():
+    assert list(split_batches([])) == []
+    hls = nodes_to_hl(Node('foo', lineno, 0, 3, 'denshiIdentifier')
+                      for lineno in range(1, 1001))
+    adds = [('nvim_buf_set_extmark', (None, 1, *hl)) for hl in hls]
+    clears = [('nvim_buf_clear_namespace', (None, 1, i, i + 1))
+              for i in range(1000)]
+    batches = list(split_batches(clears + adds, max_size=4096))
+    assert [c for batch in batches for c in batch] == clears + adds
+    # Clears are smaller, so more of them fit into a batch
+    assert len(batches[0]) > len(batches[-1]) > 1
+    # The size of every call counts, not just that of the first ones
+    for batch in batches:
+        assert len(msgpack.packb([(n, a[1:]) for n, a in batch])) + \
+            BUFFER_PACKED_SIZE * len(batch) <= 4096
+    assert len(list(split_batches(clears + adds))) == 1
+    # Sizes are upper bounds for calls of the same shape, and a group name
+    # instead of an ID makes another shape
+    named = [('nvim_buf_set_extmark', (None, 1, lineno, 0, {
+        'end_col': 100000,
+        'hl_group': 'denshi' + 'X' * 100 if lineno % 2 else 7,
+        'strict': False,
+    })) for lineno in range(100000, 101000)]
+    for batch in split_batches(named, max_size=4096):
+        assert len(msgpack.packb([(n, a[1:]) for n, a in batch])) + \
+            BUFFER_PACKED_SIZE * len(batch) <= 4096
+
+
+def test_stale_update_replaces_highlights():
+    handler, vim = make_handler()
+    handler.viewport(0, 10)
+    handler.on_lines(1, 0, -1, ['foo', 'bar'])
+    handler.update(sync=True)
+    ns = handler._ns
+    handler.on_lines(2, 1, 2, ['baz'])
+    vim.api.calls.clear()
+    handler.update(sync=True)
+    # Only the changed line is cleared
+    assert [c for c in vim.api.calls if c[0] != 'nvim_buf_set_extmark'] == [
+        ('nvim_buf_clear_namespace', (handler._buf, ns, 1, 2))]
+    # A line is inserted while the parse runs
+    parse = handler._parser.parse
+    def parse_and_insert(*args, **kwargs):
+        result = parse(*args, **kwargs)
+        handler.on_lines(4, 0, 0, ['qux'])
+        return result
+    handler._parser.parse = parse_and_insert
+    handler.on_lines(3, 1, 2, ['quux'])
+    vim.api.calls.clear()
+    handler.update(sync=True)
+    # The marks of the removed node moved to another line, so all of them
+    # are replaced
+    assert ('nvim_buf_clear_namespace', (handler._buf, ns, 0, -1)) in \
+        vim.api.calls
+    assert handler._ns != ns
+
+
+def test_serve_lines():
+    handler, vim = make_handler(decoration_provider=True)
+    handler.on_lines(1, 0, -1, ['module foo;', 'bar baz', 'qux'])
+    handler.update(sync=True)
+    vim.lua.clear()
+    handler.serve_lines(1, 3)
+    handler.serve_lines(0, 10, replace=True)
+    # Out of range lines are left out
+    handler.serve_lines(2, 1)
+    (code, args), (_, args_all), (_, args_none) = vim.lua
+    assert code == 'require("denshi.provider").set_lines(...)'
+    assert args == (1, 1, 3, [
+        [0, 3, 'denshiIdentifier', 4, 7, 'denshiIdentifier'],
+        [0, 3, 'denshiIdentifier'],
+    ], False)
+    assert args_all[1:3] == (0, 3)
+    assert args_all[3][0] == [0, 6, 'denshiKeyword', 7, 10,
+                              'denshiIdentifier']
+    assert args_all[4] is True
+    assert args_none == (1, 2, 2, [], False)
+
+
+def test_sync_update_runs_on_worker():
+    handler, vim = make_handler()
+    handler.viewport(0, 10)
+    handler.on_lines(1, 0, -1, ['foo'])
+    handler.update(sync=True)
+    handler.clear_highlights()
+    # Both wait for a job of the buffer, so they don't interleave with other
+    # jobs changing its highlights
+    assert handler._worker.submitted[-2:] == [(('update', 1), 'sync')] * 2
+    name, args = vim.api.calls[-1]
+    assert (name, args[2:]) == ('nvim_buf_clear_namespace', (0, -1))
+
+
+def test_update_delay():
+    handler, _ = make_handler(update_delay_factor=0.01)
+    handler.on_lines(1, 0, -1, ['foo'] * 50)
+    handler.update(sync=True)
+    handler.update()
+    # The delay is the worker's, the job doesn't sleep
+    assert handler._worker.submitted[-1] == (('update', 1), 0.5)
+
+
+def test_set_rank():
+    handler, _ = make_handler()
+    handler.set_rank(RANK_HIDDEN)
+    handler.set_rank(RANK_HIDDEN)
+    handler.set_rank(RANK_VISIBLE)
+    # All kinds of jobs are re-ranked, but only updates get a new delay
+    assert handler._worker.rescheduled == [
+        (('update', 1), RANK_HIDDEN, 1.0),
+        (('viewport', 1), RANK_HIDDEN, None),
+        (('error', 1), RANK_HIDDEN, None),
+        (('update', 1), RANK_VISIBLE, 0),
+        (('viewport', 1), RANK_VISIBLE, None),
+        (('error', 1), RANK_VISIBLE, None),
+    ]
+
+
+def test_async_update_includes_changes_during_delay():
+    async def request(name, *args):
+        return [1, 0]
+
+    async def main():
+        pipeline = SimpleNamespace(
+            loop=asyncio.get_running_loop(), session=None,
+            nvim=SimpleNamespace(request=request), slots=ParseSlots(1))
+        handler, _ = make_handler(pipeline, update_delay_factor=0.05)
+        parses = []
+        parse_async = handler._parser.parse_async
+        def count_parses(code, *args, **kwargs):
+            parses.append(code)
+            return parse_async(code, *args, **kwargs)
+        handler._parser.parse_async = count_parses
+        handler.on_lines(1, 0, -1, ['foo', 'bar'])
+        handler.update(changed=True)
+        await handler._update_task
+        handler.on_lines(2, 0, 1, ['baz'])
+        handler.update(changed=True)
+        await asyncio.sleep(0.01)
+        # Changed while the update waits for its delay
+        handler.on_lines(3, 1, 2, ['qux'])
+        handler.update(changed=True)
+        await handler._update_task
+        assert parses == ['foo\nbar', 'baz\nqux']
+    asyncio.run(main())
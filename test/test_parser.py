@@ -772,10 +772,9 @@ def test_exclude_types_same_nodes():
     assert [n.pos for n in parser.same_nodes((1, 0))] == [(1, 0), (1, 3)]
 
 
-def test_make_nodes():
-    """parser._make_nodes should work without a `lines` argument."""
+def test_make_table():
     parser = Parser()
-    parser._make_nodes('x')
+    parser._make_table('x')
 
 
 def test_unused_args():
@@ -853,13 +852,15 @@ def test_diff():
     assert add0[0].id == rem[0].id
 
 
-def test_minor_change():
-    def minor_change(c1, c2):
-        return Parser._minor_change(c1, c2)
-    assert minor_change(list('abc'), list('axc')) == (True, 1)
-    assert minor_change(list('abc'), list('xbx')) == (False, None)
-    assert minor_change(list('abc'), list('abcedf')) == (False, None)
-    assert minor_change(list('abc'), list('abc')) == (True, None)
+def test_changed_hunk():
+    def changed_hunk(c1, c2):
+        return Parser._changed_hunk(c1, c2)
+    assert changed_hunk(list('abc'), list('axc')) == (1, 2, 2)
+    assert changed_hunk(list('abc'), list('xbx')) == (0, 3, 3)
+    assert changed_hunk(list('abc'), list('abcedf')) == (3, 3, 6)
+    assert changed_hunk(list('abc'), list('abc')) == (3, 3, 3)
+    assert changed_hunk(list('abc'), list('ac')) == (1, 2, 1)
+    assert changed_hunk(list('aaa'), list('aaaa')) == (3, 3, 4)
 
 
 def test_specific_grammar(request):
@@ -0,0 +1,227 @@
+import asyncio
+
+import pytest
+
+from denshi.parser import Parser, UnparsableError
+from denshi.pipeline import AsyncParserSession, ParseSlots
+from denshi.session import (SessionCrashed, SessionError,
+                            SessionUnavailable)
+from denshi.worker import RANK_CURRENT, RANK_HIDDEN, RANK_VISIBLE
+
+from .conftest import FAKE_PARSER
+
+
+CRASH = '__denshi_fake_parser_crash__'
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_session_parse():
+    async def main():
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        try:
+            assert await session.parse('module foo;') == (
+                'denshiKeyword 1 0 6 module\n'
+                'denshiIdentifier 1 7 10 foo\n'
+            )
+            assert await session.parse('') == ''
+            assert session.starts == 1
+            # Requests are serialized
+            results = await asyncio.gather(
+                *(session.parse('a%d' % i) for i in range(5)))
+            assert results == ['denshiIdentifier 1 0 2 a%d\n' % i
+                               for i in range(5)]
+        finally:
+            await session.close()
+    run(main())
+
+
+def test_session_crash():
+    async def main():
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        await session.parse('foo')
+        with pytest.raises(SessionCrashed):
+            await session.parse(CRASH)
+        assert session.available
+        assert await session.parse('bar') == 'denshiIdentifier 1 0 3 bar\n'
+        for i in range(session.max_restarts + 1):
+            with pytest.raises(SessionCrashed):
+                await session.parse(CRASH + str(i))
+        assert not session.available
+        with pytest.raises(SessionUnavailable):
+            await session.parse('foo')
+        await session.close()
+    run(main())
+
+
+def test_parse_async():
+    async def main():
+        parser = Parser('config.toml', FAKE_PARSER)
+        add, rem = await parser.parse_async('foo\nbar')
+        assert [n.name for n in add] == ['foo', 'bar']
+        assert rem == []
+        add, rem = await parser.parse_async('foo\nbaz', hunk=(1, 2, 2))
+        assert [n.name for n in add] == ['baz']
+        assert [n.name for n in rem] == ['bar']
+        assert parser.tick == 2
+    run(main())
+
+
+def test_parse_async_session():
+    async def main():
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        parser = Parser('config.toml', FAKE_PARSER)
+        try:
+            add, _ = await parser.parse_async('foo', session=session)
+            assert [n.name for n in add] == ['foo']
+            assert session.starts == 1
+        finally:
+            await session.close()
+    run(main())
+
+
+def test_parse_async_session_crash():
+    async def main():
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        parser = Parser('config.toml', FAKE_PARSER)
+        try:
+            await parser.parse_async('foo', session=session)
+            # Parsed by a single run instead
+            add, _ = await parser.parse_async(CRASH, session=session)
+            assert [n.name for n in add] == [CRASH]
+            assert session.available
+        finally:
+            await session.close()
+    run(main())
+
+
+def test_parse_async_without_serve(monkeypatch):
+    async def main():
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        parser = Parser('config.toml', FAKE_PARSER)
+        for i in range(session.max_restarts + 2):
+            add, _ = await parser.parse_async('foo%d' % i, session=session)
+            assert [n.name for n in add] == ['foo%d' % i]
+        assert not session.available
+        assert session.starts == 1
+    monkeypatch.setenv('DENSHI_FAKE_PARSER_NO_SERVE', '1')
+    run(main())
+
+
+def test_parse_async_session_error(monkeypatch):
+    async def main():
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        async def request(proc, data):
+            raise SessionError('invalid input')
+        monkeypatch.setattr(session, '_request', request)
+        parser = Parser('config.toml', FAKE_PARSER)
+        try:
+            with pytest.raises(UnparsableError):
+                await parser.parse_async('foo', session=session)
+        finally:
+            await session.close()
+    run(main())
+
+
+def test_parse_async_cancel(monkeypatch):
+    async def main():
+        parser = Parser('config.toml', FAKE_PARSER)
+        await parser.parse_async('a\nb')
+        monkeypatch.setenv('DENSHI_FAKE_PARSER_DELAY', '5')
+        task = asyncio.ensure_future(
+            parser.parse_async('a\nc', hunk=(1, 2, 2)))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert parser.superseded == 1
+        monkeypatch.delenv('DENSHI_FAKE_PARSER_DELAY')
+        # The next parse includes the changes of the cancelled one
+        add, rem = await parser.parse_async('a\nd', hunk=(1, 2, 2))
+        assert [n.name for n in add] == ['d']
+        assert [n.name for n in rem] == ['b']
+    run(main())
+
+
+def test_parse_async_cancel_session(monkeypatch):
+    async def main():
+        monkeypatch.setenv('DENSHI_FAKE_PARSER_DELAY', '0.5')
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml')
+        parser = Parser('config.toml', FAKE_PARSER)
+        task = asyncio.ensure_future(parser.parse_async('a', session=session))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert session.abandoned == 1
+        # The same process serves the next request once it answered the
+        # abandoned one
+        add, _ = await parser.parse_async('b', session=session)
+        assert [n.name for n in add] == ['b']
+        assert session.starts == 1
+        await session.close()
+    run(main())
+
+
+def test_parse_async_cancel_session_drain_timeout(monkeypatch):
+    async def main():
+        monkeypatch.setenv('DENSHI_FAKE_PARSER_DELAY', '5')
+        session = AsyncParserSession(FAKE_PARSER, 'config.toml',
+                                     drain_timeout=0.2)
+        parser = Parser('config.toml', FAKE_PARSER)
+        task = asyncio.ensure_future(parser.parse_async('a', session=session))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        monkeypatch.delenv('DENSHI_FAKE_PARSER_DELAY')
+        # Runs on a new process after the timeout
+        add, _ = await asyncio.wait_for(
+            parser.parse_async('b', session=session), 2)
+        assert [n.name for n in add] == ['b']
+        assert session.starts == 2
+        await session.close()
+    run(main())
+
+
+def test_slots_rank():
+    async def main():
+        slots = ParseSlots(1)
+        order = []
+        async def parse(name, rank, idle=False):
+            async with slots.slot(rank, idle):
+                order.append(name)
+                await asyncio.sleep(0)
+        await slots.acquire()
+        tasks = [
+            asyncio.ensure_future(parse('hidden', RANK_HIDDEN, idle=True)),
+            asyncio.ensure_future(parse('visible', RANK_VISIBLE)),
+            asyncio.ensure_future(parse('current', RANK_CURRENT)),
+        ]
+        await asyncio.sleep(0)
+        assert repr(slots) == '<ParseSlots 1 / 1 used, 3 waiting>'
+        slots.release()
+        await asyncio.gather(*tasks)
+        assert order == ['current', 'visible', 'hidden']
+        assert slots.used == 0
+    run(main())
+
+
+def test_slots_idle_and_cancel():
+    async def main():
+        slots = ParseSlots(2)
+        await slots.acquire()
+        idle = asyncio.ensure_future(slots.acquire(RANK_HIDDEN, idle=True))
+        other = asyncio.ensure_future(slots.acquire(RANK_HIDDEN, idle=True))
+        await asyncio.sleep(0)
+        # A slot is free, but idle parses wait until no parse runs
+        assert not idle.done()
+        other.cancel()
+        slots.release()
+        await idle
+        assert slots.used == 1
+        slots.release()
+        assert slots.used == 0
+    run(main())
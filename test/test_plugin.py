@@ -53,7 +53,7 @@ class WrappedVim:
 
     def wait_for_update_thread(self):
         wait_for(
-            lambda: self.host_eval('plugin._cur_handler._update_thread.is_alive()'),
+            lambda: self.host_eval('plugin._worker.busy'),
             lambda x: not x,
         )
 
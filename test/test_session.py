@@ -0,0 +1,191 @@
+from threading import Event, Thread
+import time
+
+import pytest
+
+from denshi.parser import ParseCancelled, Parser, UnparsableError
+from denshi.session import (ParserSession, SessionCancelled, SessionCrashed,
+                            SessionError, SessionUnavailable)
+
+from .conftest import FAKE_PARSER
+
+
+CRASH = '__denshi_fake_parser_crash__'
+
+
+@pytest.fixture
+def session():
+    session = ParserSession(FAKE_PARSER, 'config.toml')
+    yield session
+    session.close()
+
+
+def test_parse(session):
+    assert session.parse('module foo;\n  wire bar;') == (
+        'denshiKeyword 1 0 6 module\n'
+        'denshiIdentifier 1 7 10 foo\n'
+        'denshiKeyword 2 2 6 wire\n'
+        'denshiIdentifier 2 7 10 bar\n'
+    )
+    assert session.parse('') == ''
+    assert session.starts == 1
+
+
+def test_crash_fails_request(session):
+    session.parse('foo')
+    with pytest.raises(SessionCrashed):
+        session.parse(CRASH)
+    # Retried once, as the process might have died before the request
+    assert session.starts == 2
+    assert session.available
+    assert session.parse('bar') == 'denshiIdentifier 1 0 3 bar\n'
+    assert session.starts == 3
+
+
+def test_disabled_after_crashes_on_different_inputs():
+    session = ParserSession(FAKE_PARSER, 'config.toml', retry_after=0.1)
+    session.parse('foo')
+    for _ in range(session.max_restarts + 1):
+        # The same input counts once
+        with pytest.raises(SessionCrashed):
+            session.parse(CRASH)
+    assert session.available
+    for i in range(session.max_restarts):
+        with pytest.raises(SessionCrashed):
+            session.parse(CRASH + str(i))
+    assert not session.available
+    with pytest.raises(SessionUnavailable):
+        session.parse('foo')
+    time.sleep(0.1)
+    assert session.available
+    assert session.parse('foo') == 'denshiIdentifier 1 0 3 foo\n'
+    session.close()
+
+
+def test_parser_crash_falls_back_to_single_run(session):
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    parser.parse('foo')
+    add, _ = parser.parse('foo ' + CRASH)
+    assert CRASH in [n.name for n in add]
+    assert session.available
+
+
+def test_never_answered_is_unavailable(monkeypatch):
+    monkeypatch.setenv('DENSHI_FAKE_PARSER_NO_SERVE', '1')
+    session = ParserSession(FAKE_PARSER, 'config.toml')
+    with pytest.raises(SessionUnavailable):
+        session.parse('foo')
+    assert not session.available
+    assert session.starts == 1
+
+
+def test_parser_without_serve(monkeypatch):
+    monkeypatch.setenv('DENSHI_FAKE_PARSER_NO_SERVE', '1')
+    session = ParserSession(FAKE_PARSER, 'config.toml')
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    for i in range(session.max_restarts + 2):
+        add, _ = parser.parse('foo%d' % i)
+        assert [n.name for n in add] == ['foo%d' % i]
+    # The session isn't started again before retry_after
+    assert session.starts == 1
+
+
+def test_recovers_from_single_crash(session):
+    session.parse('foo')
+    session._proc.kill()
+    assert session.parse('bar') == 'denshiIdentifier 1 0 3 bar\n'
+    assert session.starts == 2
+
+
+def test_unavailable_binary():
+    session = ParserSession('/nonexistent/denshi-parser', 'config.toml')
+    with pytest.raises(SessionUnavailable):
+        session.parse('foo')
+
+
+def test_parser_uses_session(session):
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    add, rem = parser.parse('foo\nbar')
+    assert [n.name for n in add] == ['foo', 'bar']
+    assert rem == []
+    add, rem = parser.parse('foo\nbaz')
+    assert [n.name for n in add] == ['baz']
+    assert [n.name for n in rem] == ['bar']
+    assert session.starts == 1
+
+
+def test_parser_falls_back_to_single_run(session):
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    session.available = False
+    add, _ = parser.parse('foo')
+    assert [n.name for n in add] == ['foo']
+    assert session.starts == 0
+
+
+def test_parser_session_error(session, monkeypatch):
+    def request(proc, data, cancel):
+        raise SessionError('invalid input')
+    monkeypatch.setattr(session, '_request', request)
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    with pytest.raises(UnparsableError):
+        parser.parse('foo')
+
+
+def interrupt_parse(parser, after):
+    """Start parsing 'foo' with `parser` in a thread and cancel it `after`
+    seconds later. Return the seconds until the parse returned."""
+    result = []
+    def parse():
+        try:
+            parser.parse('foo')
+        except ParseCancelled:
+            result.append('cancelled')
+    thread = Thread(target=parse)
+    thread.start()
+    time.sleep(after)
+    start = time.monotonic()
+    parser.cancel()
+    thread.join()
+    assert result == ['cancelled']
+    return time.monotonic() - start
+
+
+def test_interrupt(monkeypatch):
+    monkeypatch.setenv('DENSHI_FAKE_PARSER_DELAY', '0.5')
+    session = ParserSession(FAKE_PARSER, 'config.toml')
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    assert interrupt_parse(parser, 0.2) < 0.2
+    assert parser.superseded == 1
+    assert session.abandoned == 1
+    assert session.available
+    assert session._crashed_inputs == set()
+    # The same process serves the next request once it answered the
+    # abandoned one
+    add, _ = parser.parse('bar')
+    assert [n.name for n in add] == ['bar']
+    assert session.starts == 1
+    session.close()
+
+
+def test_interrupt_drain_timeout(monkeypatch):
+    monkeypatch.setenv('DENSHI_FAKE_PARSER_DELAY', '5')
+    session = ParserSession(FAKE_PARSER, 'config.toml', drain_timeout=0.2)
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    interrupt_parse(parser, 0.2)
+    monkeypatch.delenv('DENSHI_FAKE_PARSER_DELAY')
+    start = time.monotonic()
+    add, _ = parser.parse('bar')
+    assert time.monotonic() - start < 2
+    assert [n.name for n in add] == ['bar']
+    # The process was killed after the timeout
+    assert session.starts == 2
+    assert session.available
+    session.close()
+
+
+def test_interrupt_waiting_request(session):
+    cancel = Event()
+    session.interrupt(cancel)
+    with pytest.raises(SessionCancelled):
+        session.parse('foo', cancel)
+    assert session.starts == 0
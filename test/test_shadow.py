@@ -0,0 +1,85 @@
+import random
+
+from denshi.parser import Parser
+from denshi.shadow import ShadowBuffer
+from denshi.util import NO_CHANGE, merge_hunks
+
+from .conftest import FAKE_PARSER
+
+
+def apply(lines, hunk, new_lines):
+    start, old_stop, new_stop = hunk
+    return lines[:start] + new_lines[start:new_stop] + lines[old_stop:]
+
+
+def test_merge_hunks():
+    assert merge_hunks(NO_CHANGE, (1, 2, 3)) == (1, 2, 3)
+    assert merge_hunks((1, 2, 3), NO_CHANGE) == (1, 2, 3)
+    # Change line 5, then insert line after line 1
+    assert merge_hunks((5, 6, 6), (1, 1, 2)) == (1, 6, 7)
+    # Insert two lines at 3, then delete the first of them
+    assert merge_hunks((3, 3, 5), (3, 4, 3)) == (3, 3, 4)
+
+
+def test_merge_hunks_random():
+    rand = random.Random(0)
+    for _ in range(200):
+        orig = ['%d' % i for i in range(20)]
+        lines = orig[:]
+        hunk = NO_CHANGE
+        for _ in range(rand.randint(1, 4)):
+            first = rand.randint(0, len(lines))
+            last = rand.randint(first, len(lines))
+            data = ['x%d' % rand.randint(0, 99)
+                    for _ in range(rand.randint(0, 3))]
+            lines[first:last] = data
+            hunk = merge_hunks(hunk, (first, last, first + len(data)))
+        assert apply(orig, hunk, lines) == lines
+
+
+def test_shadow_buffer():
+    shadow = ShadowBuffer()
+    assert shadow.snapshot() is None
+    # Events before the initial content are ignored
+    shadow.on_lines(1, 0, 1, ['foo'])
+    assert shadow.snapshot() is None
+    shadow.on_lines(2, 0, -1, ['a', 'b', 'c'])
+    assert shadow.snapshot() == ('a\nb\nc', None)
+    assert shadow.snapshot() == ('a\nb\nc', NO_CHANGE)
+    shadow.on_lines(3, 1, 2, ['B'])
+    shadow.on_lines(4, 3, 3, ['d'])
+    assert shadow.snapshot() == ('a\nB\nc\nd', (1, 3, 4))
+    shadow.on_lines(5, 0, 1, ['A'])
+    assert (shadow.snapshot_tick, shadow.changedtick) == (4, 5)
+    shadow.reset()
+    assert shadow.snapshot() is None
+
+
+def test_parser_hunk():
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('foo\nbar')
+    add, rem = parser.parse('foo\nbaz', hunk=(1, 2, 2))
+    assert [n.name for n in add] == ['baz']
+    assert [n.name for n in rem] == ['bar']
+    # An inconsistent hunk is ignored
+    add, rem = parser.parse('foo\nbaz\nqux', hunk=NO_CHANGE)
+    assert {n.name for n in parser._nodes} == {'foo', 'baz', 'qux'}
+
+
+def test_parser_shift_nodes():
+    parser = Parser('config.toml', FAKE_PARSER)
+    add0, _ = parser.parse('foo\nbar\nbaz')
+    # Insert a line
+    add, rem = parser.parse('foo\nnew\nbar\nbaz', hunk=(1, 1, 2))
+    assert [n.name for n in add] == ['new']
+    assert rem == []
+    assert [(n.name, n.lineno) for n in sorted(parser._nodes)] == [
+        ('foo', 1), ('new', 2), ('bar', 3), ('baz', 4)]
+    # Shifted nodes keep their highlight IDs
+    assert {n.id for n in parser._nodes} >= {n.id for n in add0}
+    # Delete two lines
+    add, rem = parser.parse('foo\nbaz', hunk=(1, 3, 1))
+    assert add == []
+    assert sorted(n.name for n in rem) == ['bar', 'new']
+    assert [(n.name, n.lineno) for n in sorted(parser._nodes)] == [
+        ('foo', 1), ('baz', 2)]
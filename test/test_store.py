@@ -0,0 +1,132 @@
+from denshi.node import Node
+from denshi.parser import Parser
+from denshi.store import NodeStore
+
+from .conftest import FAKE_PARSER
+
+
+def make_nodes():
+    return [
+        Node('foo', 1, 0, 3, 'g'),
+        Node('bar', 1, 4, 7, 'g'),
+        Node('baz', 3, 2, 5, 'g'),
+        Node('qux', 4, 0, 3, 'g'),
+    ]
+
+
+def test_at():
+    foo, bar, baz, qux = make_nodes()
+    store = NodeStore([qux, bar, baz, foo])
+    assert len(store) == 4
+    assert list(store) == [foo, bar, baz, qux]
+    assert store.at(1, 0) is foo
+    assert store.at(1, 2) is foo
+    assert store.at(1, 3) is None
+    assert store.at(1, 6) is bar
+    assert store.at(2, 0) is None
+    assert store.at(3, 1) is None
+    assert store.at(3, 4) is baz
+    assert store.line(1) == [foo, bar]
+    assert store.line(2) == []
+
+
+def test_remove():
+    foo, bar, baz, qux = make_nodes()
+    store = NodeStore([foo, bar, baz, qux])
+    store.remove([foo, baz])
+    assert list(store) == [bar, qux]
+    assert store.at(1, 0) is None
+    assert len(store) == 2
+
+
+def test_pop_lines_and_shift():
+    foo, bar, baz, qux = make_nodes()
+    store = NodeStore([foo, bar, baz, qux])
+    assert store.pop_lines(1, 3) == [foo, bar]
+    store.shift(3, -1)
+    assert [(n.name, n.lineno) for n in store] == [('baz', 2), ('qux', 3)]
+    assert store.at(2, 3) is baz
+    store.shift(1, 2)
+    assert [(n.name, n.lineno) for n in store] == [('baz', 4), ('qux', 5)]
+    assert store.pop_lines(0, 100) == [baz, qux]
+    assert len(store) == 0
+
+
+def test_by_name():
+    nodes = [Node('foo', lineno, col, col + 3, 'g')
+             for lineno in range(1, 6) for col in (0, 10)]
+    nodes.append(Node('bar', 2, 5, 8, 'g'))
+    store = NodeStore(reversed(nodes))
+    assert store.by_name('foo') == nodes[:10]
+    assert store.by_name('foo', 2, 3) == nodes[2:6]
+    assert store.by_name('foo', 7, 9) == []
+    assert store.by_name('baz') == []
+    store.remove([nodes[2]])
+    assert store.by_name('foo', 2, 2) == [nodes[3]]
+    store.pop_lines(1, 3)
+    store.shift(3, -2)
+    assert [(n.lineno, n.col) for n in store.by_name('foo', 1, 2)] == [
+        (1, 0), (1, 10), (2, 0), (2, 10)]
+    assert store.by_name('bar') == []
+
+
+def test_same_nodes():
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('foo bar\nbar foo\nfoo')
+    names = lambda nodes: [(n.name, n.lineno) for n in nodes]
+    assert names(parser.same_nodes((1, 1))) == [
+        ('foo', 1), ('foo', 2), ('foo', 3)]
+    assert names(parser.same_nodes((1, 1), view=(2, 3))) == [
+        ('foo', 2), ('foo', 3)]
+    assert names(parser.same_nodes((1, 1), mark_original=False)) == [
+        ('foo', 2), ('foo', 3)]
+    assert parser.same_nodes((1, 3)) == []
+
+
+def test_group_neighbor():
+    foo, bar, baz, qux = make_nodes()
+    other = Node('other', 2, 0, 5, 'h')
+    store = NodeStore([foo, bar, baz, qux, other])
+    assert store.by_group('g') == [foo, bar, baz, qux]
+    assert store.by_group('h') == [other]
+    assert store.group_neighbor('x', 1, 0, 1) is None
+    assert store.group_neighbor('g', 1, 0, 1) is bar
+    assert store.group_neighbor('g', 1, 1, 1) is bar
+    assert store.group_neighbor('g', 1, 0, 2) is baz
+    assert store.group_neighbor('g', 1, 0, -1) is qux
+    assert store.group_neighbor('g', 1, 4, -1) is foo
+    assert store.group_neighbor('g', 2, 0, 1) is baz
+    assert store.group_neighbor('g', 2, 0, -1) is bar
+    assert store.group_neighbor('g', 4, 0, 1) is foo
+    assert store.group_neighbor('g', 4, 0, 5) is foo
+    assert store.group_neighbor('h', 2, 0, 1) is other
+    assert store.group_end('g') is foo
+    assert store.group_end('h', last=True) is other
+    assert store.group_end('x') is None
+
+
+def test_location_by_hl_group():
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('module a;\nwire b;\nendmodule')
+    loc = parser.location_by_hl_group
+    assert loc('denshiKeyword', (1, 0)) == (2, 0)
+    assert loc('denshiKeyword', (1, 0), 'next', 2) == (3, 0)
+    assert loc('denshiKeyword', (1, 0), 'prev') == (3, 0)
+    assert loc('denshiKeyword', (2, 3), 'prev') == (2, 0)
+    assert loc('denshiKeyword', (2, 3), 'first') == (1, 0)
+    assert loc('denshiKeyword', (2, 3), 'last') == (3, 0)
+    assert loc('denshiNothing', (1, 0)) is None
+    assert loc('denshiNothing', (1, 0), 'last') is None
+    assert parser.locations_by_hl_group('denshiIdentifier') == [
+        (1, 7), (2, 5)]
+
+
+def test_in_lines():
+    foo, bar, baz, qux = make_nodes()
+    store = NodeStore([qux, baz, bar, foo])
+    assert store.in_lines(1, 3) == [foo, bar, baz]
+    assert store.in_lines(2, 2) == []
+    assert store.in_lines(-10, 100) == [foo, bar, baz, qux]
+    store.shift(2, 5)
+    assert store.in_lines(1, 3) == [foo, bar]
+    assert store.in_lines(8, 9) == [baz, qux]
@@ -0,0 +1,175 @@
+import random
+import pytest
+
+from denshi.node import Node, StringIds
+from denshi.parser import Parser
+from denshi.table import NodeTable
+
+from .conftest import FAKE_PARSER
+
+
+RECORDS = [
+    ('foo', 1, 0, 3, 'g'),
+    ('bar', 1, 4, 7, 'h'),
+    ('foo', 3, 2, 5, 'g'),
+]
+
+
+def diff(old, table, rows):
+    ids = StringIds()
+    for node in old:
+        node.key = ids.key(node)
+    return Parser._diff(old, table, rows, table.keys(ids))
+
+
+def test_from_records():
+    table = NodeTable.from_records(RECORDS)
+    assert len(table) == 3
+    assert table.strings == ['g', 'foo', 'h', 'bar']
+    assert list(table.records()) == RECORDS
+    # Rows are sorted like nodes
+    table = NodeTable.from_records(RECORDS[::-1])
+    assert list(table.records()) == RECORDS
+    assert [table.key(row) for row in range(3)] == \
+        [Node(*r)._tup for r in RECORDS]
+    node = table.node(1)
+    assert (node.name, node.pos, node.end, node.hl_group) == \
+        ('bar', (1, 4), 7, 'h')
+
+
+def test_line_rows():
+    table = NodeTable.from_records(RECORDS)
+    assert table.line_rows(1, 1) == range(0, 2)
+    assert table.line_rows(2, 2) == range(2, 2)
+    assert table.line_rows(2, 5) == range(2, 3)
+    assert table.line_rows(4, 5) == range(3, 3)
+
+
+def test_diff():
+    old = [Node(*r) for r in RECORDS]
+    table = NodeTable.from_records([
+        ('foo', 1, 0, 3, 'g'),
+        ('bar', 1, 4, 7, 'g'),
+        ('foo', 3, 2, 5, 'g'),
+        ('baz', 4, 0, 3, 'g'),
+    ])
+    add, rem = diff(old, table, range(len(table)))
+    assert [n._tup for n in add] == [(1, 4, 'g', 'bar'), (4, 0, 'g', 'baz')]
+    assert rem == [old[1]]
+    add, rem = diff(old, table, [0, 3])
+    assert [n.name for n in add] == ['baz']
+    assert rem == old[1:]
+
+
+def test_kept_nodes_are_not_recreated():
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('foo bar\nbaz')
+    nodes = list(parser._nodes)
+    add, rem = parser.parse('foo bar\nqux')
+    assert [n.name for n in add] == ['qux']
+    assert list(parser._nodes)[:2] == nodes[:2]
+    assert all(a is b for a, b in zip(parser._nodes, nodes[:2]))
+
+
+def test_decode():
+    output = 'g 1 0 3 foo\nh 1 4 7 bar\ng 3 2 5 foo\n'
+    assert list(NodeTable.decode(output).records()) == RECORDS
+    # Unsorted output is sorted
+    lines = output.splitlines()
+    unsorted = '\n'.join(lines[::-1])
+    assert list(NodeTable.decode(unsorted).records()) == RECORDS
+    assert len(NodeTable.decode('')) == 0
+    # Extra fields don't shift the fields of the following records
+    extra = 'g 1 0 3 foo extra\nh 1 4 7 bar\ng 3 2 5 foo\n'
+    assert list(NodeTable.decode(extra).records()) == RECORDS
+    with pytest.raises(ValueError):
+        NodeTable.decode('g 1 0 3\n')
+
+
+def test_keys():
+    table = NodeTable.from_records(RECORDS)
+    ids = StringIds()
+    keys = table.keys(ids)
+    assert keys == [ids.key(Node(*r)) for r in RECORDS]
+    assert keys == sorted(keys)
+    assert table.keys(ids) is keys
+    # Keys of some rows only
+    table = NodeTable.from_records(RECORDS)
+    assert table.keys(ids, [2, 0]) == {2: keys[2], 0: keys[0]}
+    node, = table.nodes([0], keys)
+    node.lineno += 1
+    node.update_tup()
+    assert node.key > keys[1]
+    assert node.key == ids.key(node)
+
+
+def test_diff_equal_nodes():
+    old = [Node(*r) for r in RECORDS + RECORDS[:1]]
+    table = NodeTable.from_records(RECORDS[:2] + RECORDS[1:])
+    add, rem = diff(old, table, range(len(table)))
+    assert [n._tup for n in add] == [(1, 4, 'h', 'bar')]
+    assert [n._tup for n in rem] == [(1, 0, 'g', 'foo')]
+
+
+def test_diff_random():
+    random.seed(0)
+    for _ in range(200):
+        records = [('n%d' % random.randrange(3), random.randrange(1, 8),
+                    random.randrange(4), 9, 'g%d' % random.randrange(2))
+                   for _ in range(random.randrange(12))]
+        old_records = set(records[:random.randrange(len(records) + 1)])
+        new_records = set(records[random.randrange(len(records) + 1):])
+        old = [Node(*r) for r in old_records]
+        table = NodeTable.from_records(new_records)
+        add, rem = diff(old, table, range(len(table)))
+        assert {n._tup for n in add} == \
+            {Node(*r)._tup for r in new_records - old_records}
+        assert {n._tup for n in rem} == \
+            {Node(*r)._tup for r in old_records - new_records}
+
+
+def test_diff_window():
+    code = 'foo\nbar\nbaz\nqux\nquux'
+    parser = Parser('config.toml', FAKE_PARSER, diff_window=1)
+    parser.parse(code)
+    nodes = {n.name: n for n in parser._nodes}
+    # Change a line and (as if the change affected it) a line far away
+    add, rem = parser.parse('foo\nbar\nnew\nqux\nother', hunk=(2, 3, 3))
+    assert [n.name for n in add] == ['new']
+    assert [n.name for n in rem] == ['baz']
+    # The far away line is carried over without being compared
+    assert parser._nodes.line(5) == [nodes['quux']]
+    # Without a window, all lines are compared
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse(code)
+    add, rem = parser.parse('foo\nbar\nnew\nqux\nother', hunk=(2, 3, 3))
+    assert sorted(n.name for n in add) == ['new', 'other']
+
+
+def test_inexact_hunk_replaces_nodes():
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('foo\nfoo\nbar')
+    # The inserted line could be any of the first three, so no nodes are
+    # shifted or kept
+    add, rem = parser.parse('foo\nfoo\nfoo\nbar')
+    assert [n.name for n in add] == ['foo', 'foo', 'foo', 'bar']
+    assert len(rem) == 3
+    assert parser.changed is None
+    # With the hunk of the change, only its nodes are replaced
+    add, rem = parser.parse('foo\nfoo\nfoo\nfoo\nbar', hunk=(0, 0, 1))
+    assert [(n.name, n.lineno) for n in add] == [('foo', 1)]
+    assert rem == []
+    assert parser.changed == (0, 1)
+
+
+def test_string_ids_rebuilt(monkeypatch):
+    monkeypatch.setattr('denshi.parser.STRING_IDS_SLACK', 0)
+    parser = Parser('config.toml', FAKE_PARSER)
+    parser.parse('a\nb')
+    nodes = list(parser._nodes)
+    for i in range(4):
+        add, _ = parser.parse('a\nn%d' % i, hunk=(1, 2, 2))
+        assert [n.name for n in add] == ['n%d' % i]
+        # The IDs of names which aren't used anymore are dropped
+        assert len(parser._string_ids) <= 6
+    assert list(parser._nodes)[0] is nodes[0]
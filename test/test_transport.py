@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from denshi.parser import Parser, ParseCancelled
+from denshi.session import ParserSession
+from denshi.transport import make_transport
+
+from .conftest import FAKE_PARSER
+
+
+@pytest.mark.parametrize('transport', ['tempfile', 'stdin', 'memfd'])
+def test_transport(transport):
+    parser = Parser('config.toml', FAKE_PARSER, transport=transport)
+    add, rem = parser.parse('module foo;\nendmodule')
+    assert [(n.name, n.lineno, n.col, n.end, n.hl_group) for n in add] == [
+        ('module', 1, 0, 6, 'denshiKeyword'),
+        ('foo', 1, 7, 10, 'denshiIdentifier'),
+        ('endmodule', 2, 0, 9, 'denshiKeyword'),
+    ]
+    assert rem == []
+    parser.close()
+
+
+def test_memfd_reused():
+    parser = Parser('config.toml', FAKE_PARSER, transport='memfd')
+    fd = parser._transport._file.fileno()
+    parser.parse('a long line that will be truncated')
+    add, _ = parser.parse('foo\nbar')
+    assert [n.name for n in add] == ['foo', 'bar']
+    assert parser._transport._file.fileno() == fd
+    parser.close()
+
+
+def test_unknown_transport():
+    with pytest.raises(ValueError):
+        make_transport('carrier_pigeon')
+
+
+@pytest.mark.parametrize('use_session', [False, True])
+def test_cancel(monkeypatch, use_session):
+    monkeypatch.setenv('DENSHI_FAKE_PARSER_DELAY', '0.5')
+    session = ParserSession(FAKE_PARSER, 'config.toml') if use_session \
+        else None
+    parser = Parser('config.toml', FAKE_PARSER, session=session)
+    errors = []
+    def run():
+        try:
+            parser.parse('foo')
+        except ParseCancelled as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(.1)
+    parser.cancel()
+    thread.join()
+    assert len(errors) == 1
+    assert parser.superseded == 1
+    assert list(parser._nodes) == []
+    monkeypatch.delenv('DENSHI_FAKE_PARSER_DELAY')
+    # Cancelling while idle has no effect
+    parser.cancel()
+    add, _ = parser.parse('bar')
+    assert [n.name for n in add] == ['bar']
+    assert parser.superseded == 1
+    if session is not None:
+        session.close()
@@ -0,0 +1,264 @@
+from threading import Event, Lock, Thread
+import time
+
+import pytest
+
+from denshi.worker import (PRIORITY_ERROR_SIGN, PRIORITY_UPDATE,
+                           PRIORITY_VIEWPORT, RANK_CURRENT, RANK_HIDDEN,
+                           RANK_VISIBLE, UpdateWorker)
+
+
+def wait_idle(worker, timeout=2):
+    deadline = time.monotonic() + timeout
+    while worker.busy:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def blocked_worker():
+    """Return worker busy with a job which runs until the returned event is
+    set."""
+    worker = UpdateWorker()
+    release = Event()
+    started = Event()
+    def block():
+        started.set()
+        release.wait()
+    worker.submit('block', block)
+    started.wait()
+    return worker, release
+
+
+def test_priority():
+    worker, release = blocked_worker()
+    ran = []
+    worker.submit('error', lambda: ran.append('error'), PRIORITY_ERROR_SIGN)
+    worker.submit('update', lambda: ran.append('update'), PRIORITY_UPDATE)
+    worker.submit('view', lambda: ran.append('view'), PRIORITY_VIEWPORT)
+    assert worker.depth == 3
+    release.set()
+    wait_idle(worker)
+    assert ran == ['view', 'update', 'error']
+    assert worker.depth == 0
+    worker.close()
+
+
+def test_coalesce():
+    worker, release = blocked_worker()
+    ran = []
+    worker.submit('a', lambda: ran.append('a1'))
+    worker.submit('b', lambda: ran.append('b'))
+    worker.submit('a', lambda: ran.append('a2'))
+    worker.submit('a', lambda: ran.append('a3'))
+    assert worker.depth == 2
+    assert worker.max_depth == 2
+    release.set()
+    wait_idle(worker)
+    # The job keeps its place, but runs the latest function
+    assert ran == ['a3', 'b']
+    assert worker.coalesced == 2
+    assert worker.runs == 3
+    worker.close()
+
+
+def test_coalesce_raises_priority():
+    worker, release = blocked_worker()
+    ran = []
+    worker.submit('a', lambda: ran.append('a'), PRIORITY_ERROR_SIGN)
+    worker.submit('b', lambda: ran.append('b'), PRIORITY_UPDATE)
+    worker.submit('a', lambda: ran.append('a'), PRIORITY_VIEWPORT)
+    release.set()
+    wait_idle(worker)
+    assert ran == ['a', 'b']
+    worker.close()
+
+
+def test_delay():
+    worker = UpdateWorker()
+    ran = []
+    worker.submit('late', lambda: ran.append('late'), delay=0.05)
+    worker.submit('now', lambda: ran.append('now'))
+    wait_idle(worker)
+    assert ran == ['now']
+    assert worker.depth == 1
+    time.sleep(0.1)
+    wait_idle(worker)
+    assert ran == ['now', 'late']
+    worker.close()
+
+
+def test_delay_debounce():
+    worker = UpdateWorker()
+    ran = []
+    worker.submit('a', lambda: ran.append(1), delay=0.05)
+    time.sleep(0.03)
+    worker.submit('a', lambda: ran.append(2), delay=0.05)
+    time.sleep(0.03)
+    assert ran == []
+    time.sleep(0.05)
+    wait_idle(worker)
+    assert ran == [2]
+    worker.close()
+
+
+def test_cancel_and_close():
+    worker, release = blocked_worker()
+    ran = []
+    worker.submit('a', lambda: ran.append('a'))
+    worker.submit('b', lambda: ran.append('b'))
+    worker.cancel('a')
+    release.set()
+    wait_idle(worker)
+    assert ran == ['b']
+    worker.close()
+    worker.submit('c', lambda: ran.append('c'))
+    time.sleep(0.01)
+    assert ran == ['b']
+    assert worker.depth == 0
+
+
+def test_exception():
+    worker = UpdateWorker()
+    ran = []
+    worker.submit('a', lambda: 1 / 0)
+    worker.submit('b', lambda: ran.append('b'))
+    wait_idle(worker)
+    assert ran == ['b']
+    worker.close()
+
+
+def test_wait_metrics():
+    worker, release = blocked_worker()
+    worker.submit('a', lambda: None)
+    time.sleep(0.02)
+    release.set()
+    wait_idle(worker)
+    assert worker.runs == 2
+    assert worker.max_wait >= 0.02
+    assert 0 < worker.mean_wait <= worker.max_wait
+    assert 'depth 0' in repr(worker)
+    worker.close()
+
+
+def test_rank():
+    worker, release = blocked_worker()
+    ran = []
+    worker.submit('hidden', lambda: ran.append('hidden'), PRIORITY_VIEWPORT,
+                  rank=RANK_HIDDEN)
+    worker.submit('visible', lambda: ran.append('visible'), PRIORITY_UPDATE,
+                  rank=RANK_VISIBLE)
+    worker.submit('current', lambda: ran.append('current'),
+                  PRIORITY_ERROR_SIGN)
+    release.set()
+    wait_idle(worker)
+    assert ran == ['current', 'visible', 'hidden']
+    worker.close()
+
+
+def test_reschedule():
+    worker, release = blocked_worker()
+    ran = []
+    worker.submit('a', lambda: ran.append('a'))
+    worker.submit('b', lambda: ran.append('b'))
+    worker.reschedule('a', RANK_HIDDEN)
+    worker.reschedule('missing', RANK_CURRENT)
+    assert worker.depth == 2
+    release.set()
+    wait_idle(worker)
+    assert ran == ['b', 'a']
+    # Without a delay, a job keeps its due time
+    worker.submit('c', lambda: ran.append('c'), delay=60)
+    worker.reschedule('c', RANK_VISIBLE)
+    time.sleep(0.05)
+    assert ran == ['b', 'a']
+    worker.reschedule('c', RANK_VISIBLE, delay=0)
+    wait_idle(worker)
+    assert ran == ['b', 'a', 'c']
+    worker.close()
+
+
+def test_threads_and_groups():
+    worker = UpdateWorker(threads=2)
+    release = Event()
+    lock = Lock()
+    running = []
+    peak = []
+    def job(name):
+        with lock:
+            running.append(name)
+            peak.append(list(running))
+        release.wait()
+        with lock:
+            running.remove(name)
+    worker.submit('a1', lambda: job('a1'), group='a')
+    worker.submit('a2', lambda: job('a2'), group='a')
+    worker.submit('b', lambda: job('b'), group='b')
+    worker.submit('c', lambda: job('c'), group='c')
+    time.sleep(0.05)
+    # Two threads, and the jobs of group a don't run at the same time
+    assert sorted(running) == ['a1', 'b']
+    release.set()
+    wait_idle(worker)
+    assert max(len(p) for p in peak) == 2
+    assert not any({'a1', 'a2'} <= set(p) for p in peak)
+    assert worker.runs == 4
+    worker.close()
+
+
+def test_idle():
+    worker = UpdateWorker(threads=2)
+    release = Event()
+    started = Event()
+    ran = []
+    def block():
+        started.set()
+        release.wait()
+    worker.submit('block', block)
+    started.wait()
+    worker.submit('idle', lambda: ran.append('idle'), idle=True)
+    time.sleep(0.05)
+    # A thread is free, but the idle job waits for the running job
+    assert ran == []
+    # Queuing it as a regular job makes it run
+    worker.submit('idle', lambda: ran.append('regular'))
+    time.sleep(0.05)
+    assert ran == ['regular']
+    release.set()
+    wait_idle(worker)
+    worker.close()
+
+
+def test_run():
+    scheduled = []
+    worker = UpdateWorker(async_call=scheduled.append)
+    release = Event()
+    started = Event()
+    def block():
+        started.set()
+        release.wait()
+    worker.submit('block', block)
+    started.wait()
+    ran = []
+    calls = []
+    worker.submit('update', lambda: ran.append('update'))
+    def sync():
+        ran.append('sync')
+        # Would block forever if the waiting main thread didn't run it
+        calls.append(worker.wait_main(lambda: 'main'))
+        worker.call_main(calls.append, 'call')
+        return 'result'
+    Thread(target=lambda: (time.sleep(0.05), release.set())).start()
+    assert worker.run('sync', sync) == 'result'
+    # The calls it queued ran already
+    assert calls == ['main', 'call']
+    wait_idle(worker)
+    # Runs before waiting jobs
+    assert ran == ['sync', 'update']
+    # The calls were also scheduled on the main loop, where they find
+    # nothing left to run
+    assert scheduled == [worker.run_main_calls] * 2
+    def fail():
+        raise ValueError('failed')
+    with pytest.raises(ValueError):
+        worker.run('sync', fail)
+    worker.close()